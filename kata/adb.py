@@ -0,0 +1,65 @@
+import asyncio
+import logging
+import weakref
+
+import kata.db
+import kata.memo
+
+_config = None
+_pools = weakref.WeakKeyDictionary()
+
+def initialize(config):
+    global _config
+    _config = config
+
+async def _get_pool():
+    # asyncpg pools belong to the event loop they were created on, so create one lazily for each loop. the task is
+    # stored rather than the pool, so coroutines that arrive while it's connecting wait for the same pool
+    loop = asyncio.get_running_loop()
+    if loop not in _pools:
+        import asyncpg
+        _pools[loop] = asyncio.ensure_future(asyncpg.create_pool(
+            database=_config.get('name', ''),
+            min_size=1,
+            max_size=_config.get('pool_size', 10),
+            host=_config.get('host', 'localhost'),
+            password=_config.get('password', ''),
+            port=_config.get('port', 5432),
+            user=_config.get('user', '')
+        ))
+
+    return await _pools[loop]
+
+def _sql(sql, args):
+    # like psycopg2, only treat % as a placeholder when there are arguments to substitute
+    if args is None:
+        return sql
+
+    return kata.db._positional(sql)
+
+async def close():
+    pool = _pools.pop(asyncio.get_running_loop(), None)
+    if pool:
+        await (await pool).close()
+
+async def execute(sql, args=None, debug=False):
+    logging.debug('Running SQL: ' + str((sql, args)))
+    if debug:
+        print('Running SQL: ' + str((sql, args)))
+
+    if not kata.db._is_read(sql):
+        kata.memo.clear()
+
+    pool = await _get_pool()
+    await pool.execute(_sql(sql, args), *(args or []))
+
+async def query(sql, args=None, debug=False):
+    logging.debug('Running SQL: ' + str((sql, args)))
+    if debug:
+        print('Running SQL: ' + str((sql, args)))
+
+    if not kata.db._is_read(sql):
+        kata.memo.clear()
+
+    pool = await _get_pool()
+    return await pool.fetch(_sql(sql, args), *(args or []))
@@ -1,12 +1,175 @@
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import datetime
+import decimal
+import hashlib
+import heapq
+import importlib
+import itertools
+import logging
+import os
+import pickle
+import threading
+import time
+import weakref
+import zlib
+
+_codec_ids = {'pickle': 1, 'msgpack': 2}
+_compressed_lz4 = 0x20
+_compressed_zlib = 0x10
+_msgpack_classes = {}
+_purge_batch_size = 10
+_purge_order = itertools.count()
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _decode(data):
+    # values written before codecs existed are bare pickles, whose first byte is always the pickle protocol opcode
+    header = data[0]
+    if header == 0x80:
+        return pickle.loads(data)
+
+    data = data[1:]
+    if header & _compressed_zlib:
+        data = zlib.decompress(data)
+    elif header & _compressed_lz4:
+        import lz4.frame
+        data = lz4.frame.decompress(data)
+
+    if header & 0x0f == _codec_ids['msgpack']:
+        import msgpack
+        return msgpack.unpackb(data, ext_hook=_msgpack_ext, raw=False, strict_map_key=False)
+
+    return pickle.loads(data)
+
 def _deserialize(data):
-    import pickle
     return pickle.loads(data)
 
+def _encode(value, codec='pickle', compress=None, compress_threshold=1024):
+    if codec == 'msgpack':
+        import msgpack
+        # with strict types, tuples and subclasses of built-in types go through _msgpack_default rather than being
+        # silently converted into lists and dicts
+        data = msgpack.packb(value, default=_msgpack_default, use_bin_type=True, strict_types=True)
+    else:
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    # a header byte records the codec and compression, so values written with different settings can coexist
+    header = _codec_ids[codec]
+    if compress and len(data) >= compress_threshold:
+        if compress == 'lz4':
+            import lz4.frame
+            data = lz4.frame.compress(data)
+            header |= _compressed_lz4
+        else:
+            data = zlib.compress(data)
+            header |= _compressed_zlib
+
+    return bytes([header]) + data
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+def _msgpack_default(obj):
+    import kata.db
+    import msgpack
+
+    if isinstance(obj, kata.db.Object):
+        # compact rows are created at runtime, so refer to the model they were created from
+        cls = obj.__class__.__mro__[1] if obj.__columns__ is not None else obj.__class__
+        return msgpack.ExtType(1, msgpack.packb(
+            [cls.__module__, cls.__qualname__, obj.fields()],
+            default=_msgpack_default,
+            use_bin_type=True,
+            strict_types=True
+        ))
+    elif isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(2, obj.isoformat().encode('utf-8'))
+    elif isinstance(obj, datetime.date):
+        return msgpack.ExtType(3, obj.isoformat().encode('utf-8'))
+    elif isinstance(obj, decimal.Decimal):
+        return msgpack.ExtType(4, str(obj).encode('utf-8'))
+    elif type(obj) is tuple:
+        return msgpack.ExtType(5, msgpack.packb(
+            list(obj),
+            default=_msgpack_default,
+            use_bin_type=True,
+            strict_types=True
+        ))
+
+    # anything else msgpack can't represent is pickled
+    return msgpack.ExtType(0, pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+def _msgpack_ext(code, data):
+    import msgpack
+
+    if code == 1:
+        module, qualname, fields = msgpack.unpackb(data, ext_hook=_msgpack_ext, raw=False, strict_map_key=False)
+        if (module, qualname) not in _msgpack_classes:
+            cls = importlib.import_module(module)
+            for name in qualname.split('.'):
+                cls = getattr(cls, name)
+            _msgpack_classes[(module, qualname)] = cls
+
+        return _msgpack_classes[(module, qualname)](**fields)
+    elif code == 2:
+        return datetime.datetime.fromisoformat(data.decode('utf-8'))
+    elif code == 3:
+        return datetime.date.fromisoformat(data.decode('utf-8'))
+    elif code == 4:
+        return decimal.Decimal(data.decode('utf-8'))
+    elif code == 5:
+        return tuple(msgpack.unpackb(data, ext_hook=_msgpack_ext, raw=False, strict_map_key=False))
+    elif code == 0:
+        return pickle.loads(data)
+
+    return msgpack.ExtType(code, data)
+
 def _serialize(data):
-    import pickle
-    return pickle.dumps(data)
+    return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
 
 class _Cache:
+    async def aadd(self, key, value, expire=None):
+        return key in await self.aadd_multi({key: value}, expire)
+
+    async def aadd_multi(self, value_map, expire=None):
+        # clients without async support run on a thread, so they don't block the event loop
+        return await asyncio.to_thread(self.add_multi, value_map, expire)
+
+    async def adelete(self, key):
+        await self.adelete_multi([key])
+
+    async def adelete_multi(self, keys):
+        await asyncio.to_thread(self.delete_multi, keys)
+
+    async def aget(self, key):
+        return (await self.aget_multi([key])).get(key)
+
+    async def aget_multi(self, keys):
+        return await asyncio.to_thread(self.get_multi, keys)
+
+    async def arelease(self, key):
+        await self.arelease_multi([key])
+
+    async def arelease_multi(self, keys):
+        await self.adelete_multi(keys)
+
+    async def aset(self, key, value, expire=None):
+        await self.aset_multi({key: value}, expire)
+
+    async def aset_multi(self, value_map, expire=None):
+        await asyncio.to_thread(self.set_multi, value_map, expire)
+
+    def add(self, key, value, expire=None):
+        return key in self.add_multi({key: value}, expire)
+
+    def add_multi(self, value_map, expire=None):
+        raise NotImplementedError()
+
     def delete(self, key):
         raise NotImplementedError()
 
@@ -19,6 +182,13 @@ class _Cache:
     def get_multi(self, keys):
         raise NotImplementedError()
 
+    def release(self, key):
+        self.release_multi([key])
+
+    def release_multi(self, keys):
+        # releases locks taken with add, which only need to be deleted
+        self.delete_multi(keys)
+
     def set(self, key, value, expire=None):
         raise NotImplementedError()
 
@@ -31,83 +201,269 @@ class Memcached(_Cache):
         self.prefix = prefix
         self.store = pylibmc.Client(hosts, binary=True)
 
+        # pylibmc clients aren't thread-safe, and caches are shared by async gets, the refresh pool and the pull pool,
+        # so each thread uses its own copy of the client
+        self._pool = pylibmc.ThreadMappedPool(self.store)
+
     def _key(self, key):
         return self.prefix + str(key)
 
+    def add_multi(self, value_map, expire=0):
+        with self._pool.reserve() as store:
+            failed = store.add_multi(value_map, time=expire or 0, key_prefix=self.prefix)
+        return [key for key in value_map.keys() if key not in failed]
+
     def delete(self, key):
-        self.store.delete(self._key(key))
+        with self._pool.reserve() as store:
+            store.delete(self._key(key))
 
     def delete_multi(self, keys):
-        self.store.delete_multi(keys, key_prefix=self.prefix)
+        with self._pool.reserve() as store:
+            store.delete_multi(keys, key_prefix=self.prefix)
 
     def get(self, key):
-        return self.store.get(self._key(key))
+        with self._pool.reserve() as store:
+            return store.get(self._key(key))
 
     def get_multi(self, keys):
-        return self.store.get_multi(keys, key_prefix=self.prefix)
+        with self._pool.reserve() as store:
+            return store.get_multi(keys, key_prefix=self.prefix)
 
     def set(self, key, value, expire=0):
-        self.store.set(self._key(key), value, time=expire)
+        with self._pool.reserve() as store:
+            store.set(self._key(key), value, time=expire)
 
     def set_multi(self, value_map, expire=0):
-        self.store.set_multi(value_map, time=expire, key_prefix=self.prefix)
+        with self._pool.reserve() as store:
+            store.set_multi(value_map, time=expire, key_prefix=self.prefix)
 
 class Memory(_Cache):
-    def __init__(self):
-        self._data = {}
+    def __init__(self, max_items=None, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self.clear()
+
+    async def aadd_multi(self, value_map, expire=None):
+        return self.add_multi(value_map, expire)
+
+    async def adelete_multi(self, keys):
+        self.delete_multi(keys)
+
+    async def aget_multi(self, keys):
+        return self.get_multi(keys)
+
+    async def aset_multi(self, value_map, expire=None):
+        self.set_multi(value_map, expire)
+
+    def _evict(self):
+        # evict least recently used entries until we're back under the limits
+        while self._data and (
+            (self.max_items and len(self._data) > self.max_items) or
+            (self.max_bytes and self._bytes > self.max_bytes)
+        ):
+            key = next(iter(self._data))
+            self._remove(key)
+            self.evictions += 1
+
+    def _purge(self):
+        # remove a bounded number of expired entries on each write, so that keys that are never read again don't
+        # accumulate, without any single write paying for a full scan
+        now = time.time()
+        for _ in range(_purge_batch_size):
+            if not self._expires or self._expires[0][0] > now:
+                break
+
+            expire, _, key = heapq.heappop(self._expires)
+            entry = self._data.get(key)
+            if entry is not None and entry[1] == expire:
+                self._remove(key)
+
+        # overwritten keys leave stale entries in the heap, so rebuild it if they start to dominate
+        if len(self._expires) > 2 * len(self._data) + _purge_batch_size:
+            self._expires = [(entry[1], i, key) for i, (key, entry) in enumerate(self._data.items()) if entry[1]]
+            heapq.heapify(self._expires)
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def add_multi(self, value_map, expire=None):
+        added = []
+        with self._lock:
+            for key, value in value_map.items():
+                entry = self._data.get(key)
+                if entry is None or (entry[1] and time.time() > entry[1]):
+                    self.set(key, value, expire)
+                    added.append(key)
+
+        return added
 
     def clear(self):
-        self._data = {}
+        with self._lock:
+            self._bytes = 0
+            self._data = collections.OrderedDict()
+            self._expires = []
 
     def delete(self, key):
-        self._data.pop(key, None)
+        with self._lock:
+            self._remove(key)
 
     def delete_multi(self, keys):
-        for key in keys:
-            self._data.pop(key, None)
+        with self._lock:
+            for key in keys:
+                self._remove(key)
 
     def get(self, key):
-        import time
-        value, expire = self._data.get(key, (None, None))
-        if expire and time.time() > expire:
-            self.delete(key)
-            return None
+        with self._lock:
+            value, expire, _ = self._data.get(key, (None, None, 0))
+            if expire and time.time() > expire:
+                self._remove(key)
+                value = None
 
-        return value
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._data.move_to_end(key)
+            return value
 
     def get_multi(self, keys):
         return {key: self.get(key) for key in keys}
 
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
     def set(self, key, value, expire=None):
-        import time
-        self._data[key] = (value, time.time() + expire) if expire else (value, None)
+        # sizes are only measured when there's a byte limit, since serializing every value isn't free
+        size = len(_serialize(value)) if self.max_bytes else 0
+        expire = time.time() + expire if expire else None
+
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (value, expire, size)
+            self._bytes += size
+            if expire:
+                heapq.heappush(self._expires, (expire, next(_purge_order), key))
+
+            self._purge()
+            self._evict()
 
     def set_multi(self, value_map, expire=None):
         for k, v in value_map.items():
             self.set(k, v, expire)
 
+    def size(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'bytes': self._bytes,
+            'evictions': self.evictions,
+            'hit_ratio': self.hit_ratio(),
+            'hits': self.hits,
+            'items': self.size(),
+            'misses': self.misses,
+        }
+
 class Redis(_Cache):
-    def __init__(self, db, host, prefix):
+    def __init__(self, db, host, prefix, codec='pickle', compress=None, compress_threshold=1024, chunk_size=500):
         host_parts = host.split(':')
+        self.chunk_size = chunk_size
+        self.codec = codec
+        self.compress = compress
+        self.compress_threshold = compress_threshold
         self.prefix = prefix
+        self._astores = weakref.WeakKeyDictionary()
+        self._connection = {'db': db, 'host': host_parts[0], 'port': host_parts[1]}
 
         import redis
-        self.store = redis.StrictRedis(
-            db=db,
-            host=host_parts[0],
-            port=host_parts[1]
-        )
+        self.store = redis.StrictRedis(**self._connection)
+
+    def _astore(self):
+        # async clients belong to the event loop they were created on, so create one lazily for each loop
+        loop = asyncio.get_running_loop()
+        if loop not in self._astores:
+            import redis.asyncio
+            self._astores[loop] = redis.asyncio.StrictRedis(**self._connection)
+
+        return self._astores[loop]
+
+    def _encode(self, value):
+        return _encode(value, self.codec, self.compress, self.compress_threshold)
 
     def _key(self, key):
         return self.prefix + str(key)
 
+    async def aadd_multi(self, value_map, expire=None):
+        keys = list(value_map.keys())
+        pipe = self._astore().pipeline(transaction=False)
+        for key in keys:
+            pipe.set(self._key(key), self._encode(value_map[key]), ex=expire or None, nx=True)
+
+        return [key for key, added in zip(keys, await pipe.execute()) if added]
+
+    async def adelete_multi(self, keys):
+        keys = [self._key(key) for key in keys]
+        if not keys:
+            return
+
+        pipe = self._astore().pipeline(transaction=False)
+        for chunk in _chunks(keys, self.chunk_size):
+            pipe.delete(*chunk)
+
+        await pipe.execute()
+
+    async def aget_multi(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+
+        pipe = self._astore().pipeline(transaction=False)
+        for chunk in _chunks(keys, self.chunk_size):
+            pipe.mget([self._key(key) for key in chunk])
+
+        values = [value for chunk in await pipe.execute() for value in chunk]
+        return {k: _decode(v) if v is not None else None for k, v in zip(keys, values)}
+
+    async def aset_multi(self, value_map, expire=None):
+        items = [(self._key(key), self._encode(value)) for key, value in value_map.items()]
+        for chunk in _chunks(items, self.chunk_size):
+            pipe = self._astore().pipeline(transaction=False)
+            if expire:
+                for k, v in chunk:
+                    pipe.set(k, v, ex=expire)
+            else:
+                pipe.mset(dict(chunk))
+
+            await pipe.execute()
+
+    def add_multi(self, value_map, expire=None):
+        keys = list(value_map.keys())
+        pipe = self.store.pipeline(transaction=False)
+        for key in keys:
+            pipe.set(self._key(key), self._encode(value_map[key]), ex=expire or None, nx=True)
+
+        return [key for key, added in zip(keys, pipe.execute()) if added]
+
     def delete(self, key):
         self.store.delete(self._key(key))
 
     def delete_multi(self, keys):
-        pipe = self.store.pipeline()
-        for key in keys:
-            pipe.delete(self._key(key))
+        keys = [self._key(key) for key in keys]
+        if not keys:
+            return
+
+        # a single del per chunk, all sent in one round trip
+        pipe = self.store.pipeline(transaction=False)
+        for chunk in _chunks(keys, self.chunk_size):
+            pipe.delete(*chunk)
 
         pipe.execute()
 
@@ -116,45 +472,307 @@ class Redis(_Cache):
         if data is None:
             return data
 
-        return _deserialize(data)
+        return _decode(data)
 
     def get_multi(self, keys):
-        pipe = self.store.pipeline()
-        for key in keys:
-            pipe.get(self._key(key))
+        keys = list(keys)
+        if not keys:
+            return {}
 
-        return {k: _deserialize(v) if v is not None else None for k, v in zip(keys, pipe.execute())}
+        # a single mget per chunk, all sent in one round trip
+        pipe = self.store.pipeline(transaction=False)
+        for chunk in _chunks(keys, self.chunk_size):
+            pipe.mget([self._key(key) for key in chunk])
+
+        values = [value for chunk in pipe.execute() for value in chunk]
+        return {k: _decode(v) if v is not None else None for k, v in zip(keys, values)}
 
     def set(self, key, value, expire=None):
-        k = self._key(key)
-        self.store.set(k, _serialize(value))
+        # setting the expiration along with the value avoids a second round trip, and a window without a ttl
+        self.store.set(self._key(key), self._encode(value), ex=expire or None)
+
+    def set_multi(self, value_map, expire=None):
+        items = [(self._key(key), self._encode(value)) for key, value in value_map.items()]
+
+        # mset can't set an expiration, so values with one are set individually, flushing the pipeline every chunk
+        result = []
+        for chunk in _chunks(items, self.chunk_size):
+            pipe = self.store.pipeline(transaction=False)
+            if expire:
+                for k, v in chunk:
+                    pipe.set(k, v, ex=expire)
+            else:
+                pipe.mset(dict(chunk))
+
+            result += pipe.execute()
+
+        return result
+
+class RedisSharded(_Cache):
+    def __init__(self, db, hosts, prefix, codec='pickle', compress=None, compress_threshold=1024, chunk_size=500,
+                 virtual_nodes=160):
+        self.nodes = [
+            Redis(db, host, prefix, codec, compress, compress_threshold, chunk_size)
+            for host in hosts
+        ]
+
+        # place several points on the ring for each host, so keys are spread evenly and adding a host only moves
+        # about 1/n of them
+        ring = sorted([
+            (_hash('%s-%s' % (host, i)), node)
+            for host, node in zip(hosts, self.nodes)
+            for i in range(virtual_nodes)
+        ], key=lambda e: e[0])
+        self._ring_hashes = [e[0] for e in ring]
+        self._ring_nodes = [e[1] for e in ring]
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.nodes))
+
+    async def _amap(self, fn, groups):
+        # nodes are queried concurrently on the event loop, rather than on the thread pool
+        return await asyncio.gather(*[fn(node, items) for node, items in groups.items()])
+
+    def _group(self, keys):
+        groups = collections.defaultdict(list)
+        for key in keys:
+            groups[self._node(key)].append(key)
+
+        return groups
+
+    def _map(self, fn, groups):
+        # run each node's batch in parallel, skipping the thread pool when there's only one
+        if len(groups) == 1:
+            node, items = next(iter(groups.items()))
+            return [fn(node, items)]
+
+        return list(self._executor.map(lambda e: fn(*e), groups.items()))
+
+    def _node(self, key):
+        i = bisect.bisect(self._ring_hashes, _hash(str(key)))
+        return self._ring_nodes[i % len(self._ring_nodes)]
+
+    async def aadd_multi(self, value_map, expire=None):
+        groups = {node: {key: value_map[key] for key in keys} for node, keys in self._group(value_map.keys()).items()}
+        results = await self._amap(lambda node, values: node.aadd_multi(values, expire), groups)
+        return [key for added in results for key in added]
 
-        if expire is not None:
-            self.store.expire(k, expire)
+    async def adelete_multi(self, keys):
+        await self._amap(lambda node, keys: node.adelete_multi(keys), self._group(keys))
+
+    async def aget_multi(self, keys):
+        result = {}
+        for node_result in await self._amap(lambda node, keys: node.aget_multi(keys), self._group(keys)):
+            result.update(node_result)
+
+        return result
+
+    async def aset_multi(self, value_map, expire=None):
+        groups = {node: {key: value_map[key] for key in keys} for node, keys in self._group(value_map.keys()).items()}
+        await self._amap(lambda node, values: node.aset_multi(values, expire), groups)
+
+    def add_multi(self, value_map, expire=None):
+        groups = {node: {key: value_map[key] for key in keys} for node, keys in self._group(value_map.keys()).items()}
+        results = self._map(lambda node, values: node.add_multi(values, expire), groups)
+        return [key for added in results for key in added]
+
+    def delete(self, key):
+        self._node(key).delete(key)
+
+    def delete_multi(self, keys):
+        self._map(lambda node, keys: node.delete_multi(keys), self._group(keys))
+
+    def get(self, key):
+        return self._node(key).get(key)
+
+    def get_multi(self, keys):
+        result = {}
+        for node_result in self._map(lambda node, keys: node.get_multi(keys), self._group(keys)):
+            result.update(node_result)
+
+        return result
+
+    def set(self, key, value, expire=None):
+        self._node(key).set(key, value, expire)
 
     def set_multi(self, value_map, expire=None):
-        pipe = self.store.pipeline()
-        for key, value in value_map.items():
-            k = self._key(key)
-            pipe.set(k, _serialize(value))
+        groups = {node: {key: value_map[key] for key in keys} for node, keys in self._group(value_map.keys()).items()}
+        self._map(lambda node, values: node.set_multi(values, expire), groups)
+
+class Tiered(_Cache):
+    def __init__(self, local, remote, expire=5, channel=None):
+        self.channel = channel
+        self.expire = expire
+        self.local = local
+        self.remote = remote
+        self._lock = threading.Lock()
+        self._pid = None
+        self._pubsub = None
+
+    def _invalidate(self, message):
+        self.local.delete_multi(_deserialize(message['data']))
+
+    def _local_expire(self, expire):
+        return min(expire, self.expire) if expire else self.expire
+
+    def _publish(self, keys):
+        if self.channel:
+            self.remote.store.publish(self.channel, _serialize(list(keys)))
+
+    def _subscribe(self):
+        # listen for deletes from other workers on a background thread. threads don't survive a fork, so this is done
+        # lazily in each process rather than when the cache is created
+        if not self.channel or self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            pubsub = self.remote.store.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self._invalidate})
+            pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=self._unsubscribed)
+            self._pubsub = pubsub
+            self._pid = os.getpid()
+
+    def _unsubscribed(self, e, pubsub, thread):
+        # deletes may have been missed while disconnected, so drop every local value and subscribe again on the next
+        # call
+        logging.warning('Lost tiered cache subscription: %s' % e)
+        thread.stop()
+        pubsub.close()
+        with self._lock:
+            if self._pubsub is pubsub:
+                self._pid = None
+                self._pubsub = None
+
+        self.local.clear()
+
+    async def aadd_multi(self, value_map, expire=None):
+        return await self.remote.aadd_multi(value_map, expire)
+
+    async def adelete_multi(self, keys):
+        self.local.delete_multi(keys)
+        await self.remote.adelete_multi(keys)
+        if self.channel:
+            await asyncio.to_thread(self._publish, keys)
+
+    async def aget_multi(self, keys):
+        self._subscribe()
+        result = self.local.get_multi(keys)
+        missed = [key for key in keys if result.get(key) is None]
+        if not missed:
+            return result
+
+        remote_result = await self.remote.aget_multi(missed)
+        self.local.set_multi({k: v for k, v in remote_result.items() if v is not None}, self.expire)
+        result.update(remote_result)
+        return result
+
+    async def arelease_multi(self, keys):
+        await self.remote.adelete_multi(keys)
+
+    async def aset_multi(self, value_map, expire=None):
+        self._subscribe()
+        await self.remote.aset_multi(value_map, expire)
+        self.local.set_multi(value_map, self._local_expire(expire))
+
+    def add_multi(self, value_map, expire=None):
+        # adds are used for locks shared between workers, so they only go to the remote cache
+        return self.remote.add_multi(value_map, expire)
+
+    def delete(self, key):
+        self.local.delete(key)
+        self.remote.delete(key)
+        self._publish([key])
+
+    def delete_multi(self, keys):
+        self.local.delete_multi(keys)
+        self.remote.delete_multi(keys)
+        self._publish(keys)
+
+    def get(self, key):
+        self._subscribe()
+        value = self.local.get(key)
+        if value is not None:
+            return value
 
-            if expire is not None:
-                pipe.expire(k, expire)
+        value = self.remote.get(key)
+        if value is not None:
+            self.local.set(key, value, self.expire)
 
-        return pipe.execute()
+        return value
+
+    def get_multi(self, keys):
+        self._subscribe()
+        result = self.local.get_multi(keys)
+        missed = [key for key in keys if result.get(key) is None]
+        if not missed:
+            return result
+
+        remote_result = self.remote.get_multi(missed)
+        self.local.set_multi({k: v for k, v in remote_result.items() if v is not None}, self.expire)
+        result.update(remote_result)
+        return result
+
+    def release_multi(self, keys):
+        # locks only live in the remote cache, so releasing them doesn't need to be broadcast to other workers
+        self.remote.delete_multi(keys)
+
+    def set(self, key, value, expire=None):
+        self._subscribe()
+        self.remote.set(key, value, expire)
+        self.local.set(key, value, self._local_expire(expire))
+
+    def set_multi(self, value_map, expire=None):
+        self._subscribe()
+        self.remote.set_multi(value_map, expire)
+        self.local.set_multi(value_map, self._local_expire(expire))
+
+def _create(data):
+    if data['type'] == 'memcache' or data['type'] == 'memcached':
+        return Memcached(
+            hosts=data.get('hosts', ['localhost:11211']),
+            prefix=data.get('prefix', '')
+        )
+    elif data['type'] == 'memory':
+        return Memory(
+            max_items=data.get('max_items'),
+            max_bytes=data.get('max_bytes')
+        )
+    elif data['type'] == 'redis':
+        return Redis(
+            db=data.get('db', 0),
+            host=data.get('host', 'localhost:6379'),
+            prefix=data.get('prefix', ''),
+            codec=data.get('codec', 'pickle'),
+            compress=data.get('compress'),
+            compress_threshold=data.get('compress_threshold', 1024),
+            chunk_size=data.get('chunk_size', 500)
+        )
+    elif data['type'] == 'redis_sharded':
+        return RedisSharded(
+            db=data.get('db', 0),
+            hosts=data.get('hosts', ['localhost:6379']),
+            prefix=data.get('prefix', ''),
+            codec=data.get('codec', 'pickle'),
+            compress=data.get('compress'),
+            compress_threshold=data.get('compress_threshold', 1024),
+            chunk_size=data.get('chunk_size', 500),
+            virtual_nodes=data.get('virtual_nodes', 160)
+        )
+    elif data['type'] == 'tiered':
+        # the remote cache is configured inline, and invalidations are broadcast over redis pub/sub when possible
+        remote = _create(data['remote'])
+        channel = data.get('channel', data['remote'].get('prefix', '') + 'kata:invalidate')
+        return Tiered(
+            local=Memory(
+                max_items=data.get('max_items', 10000),
+                max_bytes=data.get('max_bytes')
+            ),
+            remote=remote,
+            expire=data.get('expire', 5),
+            channel=channel if isinstance(remote, Redis) else None
+        )
 
 def initialize(config):
     for name, data in config.items():
-        if data['type'] == 'memcache' or data['type'] == 'memcached':
-            globals()[name] = Memcached(
-                hosts=data.get('hosts', ['localhost:11211']),
-                prefix=data.get('prefix', '')
-            )
-        elif data['type'] == 'memory':
-            globals()[name] = Memory()
-        elif data['type'] == 'redis':
-            globals()[name] = Redis(
-                db=data.get('db', 0),
-                host=data.get('host', 'localhost:6379'),
-                prefix=data.get('prefix', '')
-            )
+        globals()[name] = _create(data)
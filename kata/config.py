@@ -30,10 +30,17 @@ def initialize(config_file):
             import kata.cache
             kata.cache.initialize(data['cache'])
 
+        if 'container' in data:
+            import kata.container
+            kata.container.initialize(data['container'])
+
         if 'database' in data:
             import kata.db
             kata.db.initialize(data['database'])
 
+            import kata.adb
+            kata.adb.initialize(data['database'])
+
         if 'statsd' in data:
             import kata.stats
             kata.stats.initialize(data['statsd'])
@@ -1,35 +1,649 @@
+import asyncio
+import atexit
+import concurrent.futures
+import contextlib
+import contextvars
+import inspect
+import itertools
+import logging
+import math
+import multiprocessing
+import random
+import threading
+import time
+import uuid
+
+import kata.cache
+import kata.memo
+
+_dirtied = contextvars.ContextVar('kata_dirtied', default=None)
+_generation_lock = threading.Lock()
+_generation_ttl = 1
+_generations_local = {}
+_generations_local_size = 10000
+_local = threading.local()
+_lock_poll = 0.05
+_pull_executor = None
+_pull_lock = threading.Lock()
+_pull_process_executor = None
+_pull_process_workers = None
+_pull_workers = 8
+_refresh_executor = None
+_refresh_lock = threading.Lock()
+_refresh_pending = set()
+_refresh_tasks = set()
+_refresh_queue_size = 1000
+_refresh_workers = 4
+
+class _Entry(object):
+    # cached values are wrapped with how long they took to pull and when they expire when early recomputation or
+    # stale-while-revalidate is enabled, so that a caller can decide to recompute before they actually expire
+    def __init__(self, value, delta, expire, stale=None):
+        self.value = value
+        self.delta = delta
+        self.expire = expire
+        self.stale = stale
+
+class _Missing(object):
+    # cached in place of values that don't exist, so that they aren't pulled again on every get
+    pass
+
+_missing = _Missing()
+_unmemoized = object()
+
+class _Handle(object):
+    def __init__(self, loader):
+        self._done = False
+        self._loader = loader
+        self._value = None
+
+    def get(self):
+        if not self._done:
+            self._loader.dispatch()
+
+        return self._value
+
+async def _abump(cache, namespaces):
+    generations = _new_generations(namespaces)
+    if isinstance(cache, kata.cache.Tiered):
+        await cache.adelete_multi([_generation_key(namespace) for namespace in generations.keys()])
+    await cache.aset_multi({_generation_key(namespace): generation for namespace, generation in generations.items()})
+    _remember(cache, generations)
+
+async def _agenerations(cache, namespaces):
+    result, fetch = _remembered(cache, namespaces)
+    if len(fetch) == 0:
+        return result
+
+    keys = {_generation_key(namespace): namespace for namespace in fetch}
+    cached = await cache.aget_multi(list(keys.keys()))
+
+    created = {key: uuid.uuid4().hex[:12] for key in keys.keys() if cached.get(key) is None}
+    if len(created) > 0:
+        await cache.aadd_multi(created, expire=0)
+        cached.update({k: v for k, v in (await cache.aget_multi(list(created.keys()))).items() if v is not None})
+
+    fetched = {namespace: cached.get(key) or created[key] for key, namespace in keys.items()}
+    _remember(cache, fetched)
+    result.update(fetched)
+    return result
+
+async def _ainvalidate(containers):
+    deletes, bumps = _invalidations(containers)
+    for cache, keys in deletes.values():
+        await cache.adelete_multi(keys)
+    for cache, namespaces in bumps.values():
+        await _abump(cache, namespaces)
+
+def _arefresh(key_map, fn):
+    # like _refresh, but the refresh runs as a task on the current event loop
+    keys = _reserve(key_map)
+    if len(keys) == 0:
+        return False
+
+    async def run():
+        try:
+            await fn([key_map[key] for key in keys])
+        except Exception:
+            logging.exception('Error refreshing container')
+        finally:
+            _release(keys)
+
+    # the loop only keeps weak references to tasks, so hold on to them until they finish
+    task = asyncio.get_running_loop().create_task(run())
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+    return True
+
+async def _aversioned(cache, keys, namespaces):
+    if all(namespace is None for namespace in namespaces):
+        return keys
+
+    generations = await _agenerations(cache, [namespace for namespace in namespaces if namespace is not None])
+    return _versioned_keys(keys, namespaces, generations)
+
+async def _awaited(value):
+    # pull can be a regular function or a coroutine
+    if inspect.isawaitable(value):
+        return await value
+
+    return value
+
+def _background(fn, message):
+    global _refresh_executor
+    with _refresh_lock:
+        if _refresh_executor is None:
+            _refresh_executor = concurrent.futures.ThreadPoolExecutor(max_workers=_refresh_workers)
+
+    def run():
+        try:
+            fn()
+        except Exception:
+            logging.exception(message)
+
+    _refresh_executor.submit(run)
+
+def _bump(cache, namespaces):
+    # tiered caches only tell other workers to drop their local copy on delete, so delete the old generations first
+    generations = _new_generations(namespaces)
+    if isinstance(cache, kata.cache.Tiered):
+        cache.delete_multi([_generation_key(namespace) for namespace in generations.keys()])
+    cache.set_multi({_generation_key(namespace): generation for namespace, generation in generations.items()}, expire=0)
+    _remember(cache, generations)
+
+def _closure(containers, method):
+    # resolve every container that will be dirtied before touching the cache, so the whole graph can be invalidated
+    # in one batch, only visiting each container once in case of cycles. containers that override dirty (or adirty)
+    # are returned separately so that their own method runs, unless it's already running, and dependencies that an
+    # outer call already handled are skipped
+    dirtied = _dirtied.get() or set()
+    seen = set()
+    result = []
+    overridden = []
+    stack = [(container, True) for container in containers]
+    while len(stack) > 0:
+        container, root = stack.pop()
+        identity = container._identity()
+        if identity in seen or (not root and identity in dirtied):
+            continue
+
+        seen.add(identity)
+        if identity not in dirtied and getattr(type(container), method) is not getattr(Simple, method):
+            overridden.append(container)
+            continue
+
+        result.append(container)
+        stack.extend((dependency, False) for dependency in container._dependencies())
+
+    return result, overridden
+
+@contextlib.contextmanager
+def _dirtying(containers):
+    token = _dirtied.set((_dirtied.get() or set()) | {container._identity() for container in containers})
+    try:
+        yield
+    finally:
+        _dirtied.reset(token)
+
+def _generation_key(namespace):
+    return 'generation:%s' % namespace
+
+def _generations(cache, namespaces):
+    result, fetch = _remembered(cache, namespaces)
+    if len(fetch) == 0:
+        return result
+
+    keys = {_generation_key(namespace): namespace for namespace in fetch}
+    cached = cache.get_multi(list(keys.keys()))
+
+    # namespaces that have never been dirtied get a generation, and whoever adds it first wins
+    created = {key: uuid.uuid4().hex[:12] for key in keys.keys() if cached.get(key) is None}
+    if len(created) > 0:
+        cache.add_multi(created, expire=0)
+        cached.update({k: v for k, v in cache.get_multi(list(created.keys())).items() if v is not None})
+
+    fetched = {namespace: cached.get(key) or created[key] for key, namespace in keys.items()}
+    _remember(cache, fetched)
+    result.update(fetched)
+    return result
+
+def _group(indexes, fn):
+    groups = {}
+    for i in indexes:
+        groups.setdefault(fn(i), []).append(i)
+
+    return groups
+
+def _invalidate(containers):
+    deletes, bumps = _invalidations(containers)
+    for cache, keys in deletes.values():
+        cache.delete_multi(keys)
+    for cache, namespaces in bumps.values():
+        _bump(cache, namespaces)
+
+def _invalidations(containers):
+    # one delete per cache for plain keys, and one generation bump per cache for namespaces
+    deletes = {}
+    bumps = {}
+    for container in containers:
+        for key, namespace in container._dirty_keys():
+            if namespace is None:
+                deletes.setdefault(id(container._cache), (container._cache, []))[1].append(key)
+            else:
+                bumps.setdefault(id(container._cache), (container._cache, []))[1].append(namespace)
+
+    return deletes, bumps
+
+def _lock_key(key):
+    return 'lock:%s' % key
+
+def _map(fn, items, parallel=False):
+    # pulls that are already running on the pool run their own pulls serially, since waiting on the same pool from
+    # inside of it can deadlock
+    if not parallel or len(items) < 2 or getattr(_local, 'pulling', False):
+        return [fn(item) for item in items]
+
+    def run(item):
+        _local.pulling = True
+        try:
+            return fn(item)
+        finally:
+            _local.pulling = False
+
+    return list(_pull_pool().map(run, items))
+
+def _pull_pool(processes=False):
+    global _pull_executor, _pull_process_executor
+    with _pull_lock:
+        if processes and _pull_process_executor is None:
+            # forking a threaded worker would copy its database connections and any locks held by other threads, so
+            # start workers from a clean process instead
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pull_process_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=_pull_process_workers,
+                mp_context=multiprocessing.get_context(method)
+            )
+            atexit.register(_pull_process_executor.shutdown)
+        elif not processes and _pull_executor is None:
+            _pull_executor = concurrent.futures.ThreadPoolExecutor(max_workers=_pull_workers)
+
+    return _pull_process_executor if processes else _pull_executor
+
+def _timed_pull(container, *args):
+    # runs on the pull pool, so any pulls it does itself run serially
+    pulling = getattr(_local, 'pulling', False)
+    _local.pulling = True
+    try:
+        start = time.time()
+        result = container.pull(*args)
+        return result, time.time() - start
+    finally:
+        _local.pulling = pulling
+
+def _new_generations(namespaces):
+    # a new random generation changes the keys of everything in the namespace with a single set
+    return {namespace: uuid.uuid4().hex[:12] for namespace in set(namespaces)}
+
+def _one(result):
+    if len(result.values()) == 0:
+        return None
+
+    return list(result.values())[0]
+
+def _refresh(key_map, fn):
+    keys = _reserve(key_map)
+    if len(keys) == 0:
+        return False
+
+    def run():
+        try:
+            fn([key_map[key] for key in keys])
+        finally:
+            _release(keys)
+
+    _background(run, 'Error refreshing container')
+    return True
+
+def _release(keys):
+    with _refresh_lock:
+        _refresh_pending.difference_update(keys)
+
+def _remember(cache, generations):
+    expire = time.time() + _generation_ttl
+    with _generation_lock:
+        if len(_generations_local) > _generations_local_size:
+            _generations_local.clear()
+
+        for namespace, generation in generations.items():
+            _generations_local[(id(cache), namespace)] = (generation, expire)
+
+def _remembered(cache, namespaces):
+    # generations are remembered locally for a short window, and the rest need to be fetched
+    now = time.time()
+    result = {}
+    fetch = []
+    with _generation_lock:
+        for namespace in set(namespaces):
+            local = _generations_local.get((id(cache), namespace))
+            if local is not None and local[1] > now:
+                result[namespace] = local[0]
+            else:
+                fetch.append(namespace)
+
+    return result, fetch
+
+def _reserve(key_map):
+    # refresh stale values in the background, skipping keys that are already queued, and dropping refreshes
+    # entirely when the queue is full so that a flood of stale reads can't back up the pool
+    with _refresh_lock:
+        keys = [key for key in key_map.keys() if key not in _refresh_pending]
+        keys = keys[:max(_refresh_queue_size - len(_refresh_pending), 0)]
+        _refresh_pending.update(keys)
+
+    return keys
+
+def _stale(result):
+    return isinstance(result, _Entry) and result.stale is not None and time.time() >= result.stale
+
+def _unwrap(result, beta=0):
+    # returns the cached value, and whether it should be recomputed
+    if not isinstance(result, _Entry):
+        return result, False
+
+    # XFetch: recompute early with a probability that increases as expiration approaches, weighted by how long the
+    # value takes to recompute
+    recompute = False
+    if beta and result.expire:
+        recompute = time.time() - result.delta * beta * math.log(1.0 - random.random()) >= result.expire
+
+    return result.value, recompute
+
+def _versioned(cache, keys, namespaces):
+    # keys in a namespace include its generation, so that dirtying the namespace invalidates all of them at once
+    if all(namespace is None for namespace in namespaces):
+        return keys
+
+    generations = _generations(cache, [namespace for namespace in namespaces if namespace is not None])
+    return _versioned_keys(keys, namespaces, generations)
+
+def _versioned_keys(keys, namespaces, generations):
+    return [
+        key if namespace is None else '%s@%s' % (key, generations[namespace])
+        for key, namespace in zip(keys, namespaces)
+    ]
+
+async def adirty(containers):
+    kata.memo.clear()
+    containers, overridden = _closure(containers, 'adirty')
+    with _dirtying(containers + overridden):
+        await _ainvalidate(containers)
+        for container in overridden:
+            await container.adirty()
+
+def dirty(containers, *, background=False):
+    kata.memo.clear()
+    containers, overridden = _closure(containers, 'dirty')
+    with _dirtying(containers + overridden):
+        if not background:
+            _invalidate(containers)
+        else:
+            # invalidate once the current transaction commits, so no one can cache a value from before the write, and
+            # off of the request thread
+            import kata.db as db
+            db.on_commit(lambda: _background(lambda: _invalidate(containers), 'Error dirtying containers'))
+
+        for container in overridden:
+            container.dirty(background=background)
+
+def initialize(config):
+    global _generation_ttl, _pull_process_workers, _pull_workers, _refresh_queue_size, _refresh_workers
+    _generation_ttl = config.get('generation_ttl', 1)
+    _pull_process_workers = config.get('pull_process_workers')
+    _pull_workers = config.get('pull_workers', 8)
+    _refresh_queue_size = config.get('refresh_queue_size', 1000)
+    _refresh_workers = config.get('refresh_workers', 4)
+
+def warm(container_cls, items, batch_size=1000, concurrency=1, rate=0):
+    # fills the cache for any items that aren't already cached, a batch at a time with at most concurrency batches in
+    # flight and at most rate items per second, so that warming up doesn't overload the database. returns how many
+    # items had values
+    if issubclass(container_cls, Attribute):
+        def run(batch):
+            return len(container_cls(batch).get())
+    else:
+        def run(batch):
+            containers = [container_cls(*(item if isinstance(item, tuple) else (item,))) for item in batch]
+            return len([result for result in Simple.get_multi(containers) if result is not None])
+
+    concurrency = max(concurrency, 1)
+    items = iter(items)
+    start = time.time()
+    sent = 0
+    warmed = 0
+    pending = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            while len(pending) < concurrency:
+                batch = list(itertools.islice(items, batch_size))
+                if len(batch) == 0:
+                    break
+
+                # pace batches so that items are sent no faster than the rate
+                if rate:
+                    time.sleep(max(start + sent / rate - time.time(), 0))
+
+                sent += len(batch)
+                pending.add(executor.submit(run, batch))
+
+            if len(pending) == 0:
+                return warmed
+
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            warmed += sum(future.result() for future in done)
+
 class Simple(object):
     def __init__(self, *args, **kwargs):
         self._cache = self.cache()
         self.init(*args, **kwargs)
 
-    def _dirty_dependencies(self, dirtied=None):
-        if not dirtied:
-            dirtied = set()
+    def __getstate__(self):
+        # caches hold connections and locks, so containers sent to another process get their cache from cache()
+        state = self.__dict__.copy()
+        state.pop('_cache', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache = self.cache()
+
+    async def _akey(self):
+        return (await _aversioned(self._cache, [self.key()], [self.namespace()]))[0]
+
+    async def _apull_and_set(self, key):
+        result, value, expire = await self._apull_timed()
+        if value is not None:
+            await self._cache.aset(key, value, expire=expire)
 
+        return result
+
+    async def _apull_locked(self, key, stale=None):
+        lock_expire = self.lock_expire()
+        if not lock_expire:
+            return await self._apull_and_set(key)
+
+        lock_key = _lock_key(key)
+        if await self._cache.aadd(lock_key, 1, lock_expire):
+            try:
+                return await self._apull_and_set(key)
+            finally:
+                await self._cache.arelease(lock_key)
+
+        if stale is not None:
+            return stale
+
+        deadline = time.time() + self.lock_wait()
+        while time.time() < deadline:
+            await asyncio.sleep(_lock_poll)
+            released = await self._cache.aadd(lock_key, 1, lock_expire)
+            try:
+                result, _ = _unwrap(await self._cache.aget(key))
+            finally:
+                if released:
+                    await self._cache.arelease(lock_key)
+
+            if isinstance(result, _Missing) or (result is None and released):
+                return None
+            if result is not None:
+                return result
+
+        return await self._apull_and_set(key)
+
+    async def _apull_timed(self):
+        # regular pulls run on the pull pool, so they don't block the event loop
+        if inspect.iscoroutinefunction(self.pull):
+            start = time.time()
+            result = await self.pull()
+            elapsed = time.time() - start
+        else:
+            result, elapsed = await asyncio.get_running_loop().run_in_executor(_pull_pool(), _timed_pull, self)
+            result = await _awaited(result)
+
+        return self._pulled(result, elapsed)
+
+    def _dependencies(self):
         dependencies = self.dependencies()
         if not isinstance(dependencies, list):
             dependencies = [dependencies]
 
+        result = []
         for dependency in dependencies:
-            cls = None
-            args = tuple()
+            if isinstance(dependency, Simple):
+                result.append(dependency)
+                continue
 
             # unpack dependency tuple into class, args, and kwargs
-            if len(dependency) >= 1:
-                cls = dependency[0]
+            args = tuple()
+            kwargs = {}
             if len(dependency) >= 2:
                 args = dependency[1]
                 if not isinstance(args, tuple):
                     args = tuple([args])
+            if len(dependency) >= 3:
+                kwargs = dependency[2]
 
-            # check if we've already dirtied this class
-            if (cls, args) in dirtied:
-                continue
+            result.append(dependency[0](*args, **kwargs))
+
+        return result
+
+    def _dirty_keys(self):
+        return [(self.key(), self.namespace())]
+
+    def _pull_locked(self, key, stale=None):
+        lock_expire = self.lock_expire()
+        if not lock_expire:
+            return self._pull_and_set(key)
+
+        # stampede protection: only the caller that gets the lock pulls, and everyone else serves the stale value if
+        # there is one, or waits for the value to show up in the cache
+        lock_key = _lock_key(key)
+        if self._cache.add(lock_key, 1, lock_expire):
+            try:
+                return self._pull_and_set(key)
+            finally:
+                self._cache.release(lock_key)
+
+        if stale is not None:
+            return stale
+
+        deadline = time.time() + self.lock_wait()
+        while time.time() < deadline:
+            time.sleep(_lock_poll)
+
+            # once the other caller releases the lock, whatever it pulled is already in the cache, so if there's
+            # nothing there then the value doesn't exist
+            released = self._cache.add(lock_key, 1, lock_expire)
+            try:
+                result, _ = _unwrap(self._cache.get(key))
+            finally:
+                if released:
+                    self._cache.release(lock_key)
+
+            if isinstance(result, _Missing) or (result is None and released):
+                return None
+            if result is not None:
+                return result
+
+        # the other caller is taking too long, so give up and pull anyway
+        return self._pull_and_set(key)
+
+    def _hit(self, key, cached, asynchronous=False):
+        # returns whether the cached value can be used, and the value itself
+        result, recompute = _unwrap(cached, self.early_recompute())
+        if isinstance(result, _Missing):
+            return True, None
+        if result is not None and not recompute:
+            if _stale(cached) and asynchronous:
+                _arefresh({key: key}, lambda keys: self._apull_locked(key, result))
+            elif _stale(cached):
+                _refresh({key: key}, lambda keys: self._pull_locked(key, result))
+            return True, result
+
+        return False, result
+
+    def _identity(self):
+        return (self.__class__, self.key())
+
+    def _key(self):
+        return _versioned(self._cache, [self.key()], [self.namespace()])[0]
+
+    def _pull_and_set(self, key):
+        result, value, expire = self._pull_timed()
+        if value is not None:
+            self._cache.set(key, value, expire=expire)
+
+        return result
+
+    def _pull_timed(self):
+        start = time.time()
+        result = self.pull()
+        return self._pulled(result, time.time() - start)
+
+    def _pulled(self, result, delta):
+        # returns the pulled result, along with the value to cache and its expiration
+        if result is not None:
+            return result, self._wrap(result, delta), self.expire()
+        elif self.missing_expire():
+            return result, _missing, self.missing_expire()
 
-            # dirty the class if not
-            dirtied.add((cls, args))
-            cls(*args).dirty(dirtied)
+        return result, None, None
+
+    def _wrap(self, value, delta):
+        stale = self.stale()
+        if not self.early_recompute() and not stale:
+            return value
+
+        now = time.time()
+        expire = self.expire()
+        return _Entry(value, delta, now + expire if expire else None, now + stale if stale else None)
+
+    async def adirty(self):
+        # subclasses that override adirty call this through super, so mark it as running
+        with _dirtying([self]):
+            await adirty([self])
+
+    async def aget(self):
+        key = await self._akey()
+        memo_key = (id(self._cache), key)
+        result = kata.memo.get(memo_key, _unmemoized)
+        if result is not _unmemoized:
+            return result
+
+        hit, result = self._hit(key, await self._cache.aget(key), asynchronous=True)
+        if not hit:
+            result = await self._apull_locked(key, result)
+
+        kata.memo.set(memo_key, result)
+        return result
 
     def init(self, *args, **kwargs):
         pass
@@ -40,31 +654,143 @@ class Simple(object):
     def dependencies(self):
         return []
 
-    def dirty(self, dirtied=None):
-        self._cache.delete(self.key())
-        self._dirty_dependencies(dirtied)
+    def dirty(self, *, background=False):
+        # subclasses that override dirty call this through super, so mark it as running
+        with _dirtying([self]):
+            dirty([self], background=background)
+
+    def early_recompute(self):
+        return 0
 
     def expire(self):
         return 3600
 
     def get(self):
-        key = self.key()
-        result = self._cache.get(key)
-        if result is not None:
+        key = self._key()
+        memo_key = (id(self._cache), key)
+        result = kata.memo.get(memo_key, _unmemoized)
+        if result is not _unmemoized:
             return result
 
-        result = self.pull()
-        if result is not None:
-            self._cache.set(key, result, expire=self.expire())
+        hit, result = self._hit(key, self._cache.get(key))
+        if not hit:
+            result = self._pull_locked(key, result)
 
+        kata.memo.set(memo_key, result)
         return result
 
+    @staticmethod
+    def get_multi(containers, parallel=False):
+        # containers with the same key in the same cache only need to be fetched once
+        unique = {}
+        for container in containers:
+            unique.setdefault((id(container._cache), container.key()), container)
+        names = {name: i for i, name in enumerate(unique.keys())}
+        unique = list(unique.values())
+        keys = [None] * len(unique)
+        results = {}
+
+        # perform one bulk get per cache backend, after looking up the generations of any namespaced keys
+        stale = {}
+        missed = []
+        for indexes in _group(range(len(unique)), lambda i: id(unique[i]._cache)).values():
+            cache = unique[indexes[0]]._cache
+            versioned = _versioned(cache, [unique[i].key() for i in indexes], [unique[i].namespace() for i in indexes])
+            for i, key in zip(indexes, versioned):
+                keys[i] = key
+
+            # containers already fetched during this request don't need to be fetched again
+            memoized = {i: kata.memo.get((id(cache), keys[i]), _unmemoized) for i in indexes}
+            for i, value in memoized.items():
+                if value is not _unmemoized:
+                    results[i] = value
+            indexes = [i for i in indexes if memoized[i] is _unmemoized]
+            if len(indexes) == 0:
+                continue
+
+            cached = cache.get_multi([keys[i] for i in indexes])
+            for i in indexes:
+                hit, results[i] = unique[i]._hit(keys[i], cached.get(keys[i]))
+                if not hit:
+                    stale[i] = results[i]
+                    missed.append(i)
+
+        # lock all of the misses with one add per cache backend, like a single get would
+        locked = [i for i in missed if not unique[i].lock_expire()]
+        leased = []
+        for (_, lock_expire), indexes in _group(
+                [i for i in missed if unique[i].lock_expire()],
+                lambda i: (id(unique[i]._cache), unique[i].lock_expire())
+        ).items():
+            added = set(unique[indexes[0]]._cache.add_multi({_lock_key(keys[i]): 1 for i in indexes}, lock_expire))
+            leased.extend(i for i in indexes if _lock_key(keys[i]) in added)
+        locked.extend(leased)
+
+        try:
+            # pull everything we have a lock on, and store it with one set per cache backend and expiration
+            pulled = dict(zip(locked, _map(lambda i: unique[i]._pull_timed(), locked, parallel)))
+            for i, (result, _, _) in pulled.items():
+                results[i] = result
+
+            cached = [i for i in locked if pulled[i][1] is not None]
+            for indexes in _group(cached, lambda i: (id(unique[i]._cache), pulled[i][2])).values():
+                values = {keys[i]: pulled[i][1] for i in indexes}
+                unique[indexes[0]]._cache.set_multi(values, expire=pulled[indexes[0]][2])
+        finally:
+            for indexes in _group(leased, lambda i: id(unique[i]._cache)).values():
+                unique[indexes[0]]._cache.release_multi([_lock_key(keys[i]) for i in indexes])
+
+        # anything someone else is already pulling is handled the same way a single get would
+        for i in missed:
+            if i not in pulled:
+                results[i] = unique[i]._pull_locked(keys[i], stale[i])
+
+        for i in range(len(unique)):
+            kata.memo.set((id(unique[i]._cache), keys[i]), results[i])
+
+        return [results[names[(id(container._cache), container.key())]] for container in containers]
+
     def key(self):
         raise NotImplementedError()
 
+    def lock_expire(self):
+        return 10
+
+    def lock_wait(self):
+        return 2
+
+    def missing_expire(self):
+        return 0
+
+    def namespace(self):
+        return None
+
     def pull(self):
         raise NotImplementedError()
 
+    def stale(self):
+        return 0
+
+class Loader(object):
+    def __init__(self, parallel=False):
+        self._parallel = parallel
+        self._queue = []
+
+    def dispatch(self):
+        queue, self._queue = self._queue, []
+        if len(queue) == 0:
+            return
+
+        results = Simple.get_multi([container for container, _ in queue], self._parallel)
+        for (_, handle), result in zip(queue, results):
+            handle._done = True
+            handle._value = result
+
+    def load(self, container):
+        handle = _Handle(self)
+        self._queue.append((container, handle))
+        return handle
+
 class Attribute(Simple):
     def __init__(self, items, *args, **kwargs):
         self._one = False
@@ -78,62 +804,345 @@ class Attribute(Simple):
         self.items = items
         self.init(*args, **kwargs)
 
-    def attribute(self):
-        raise NotImplementedError()
+    async def _aget(self, items, bulk_keys):
+        missed_items, refresh, stale = self._classify(items, bulk_keys, await self._cache.aget_multi(bulk_keys))
+        if len(refresh) > 0:
+            _arefresh(refresh, lambda refresh_items: self._apull_locked(refresh_items, stale))
 
-    def dirty(self):
-        self._cache.delete_multi([self.key(item) for item in self.items])
-        self._dirty_dependencies()
+        if len(missed_items) == 0:
+            return self._merge(items, stale, {})
 
-    def get(self, one=None):
-        if one is None and self._one:
-            one = True
+        return self._merge(items, stale, await self._apull_locked(missed_items, stale))
 
-        # perform a bulk get on all of the given keys
-        items = list(self.items)
-        bulk_keys = [self.key(item) for item in items]
-        cached_result = self._cache.get_multi(bulk_keys)
+    async def _akeys(self, items):
+        return await _aversioned(
+            self._cache,
+            [self.key(item) for item in items],
+            [self.namespace(item) for item in items]
+        )
+
+    async def _apull(self, items):
+        # the default pull has an async version using the model's aget
+        if type(self).pull is not Attribute.pull:
+            return await self.pull(items)
+
+        model, column = self.attribute()
+        return {getattr(e, column): e for e in await model.aget(where_in=(column, items))}
+
+    async def _apull_and_set(self, items):
+        chunks = self._chunks(items)
+        semaphore = asyncio.Semaphore(max(self.pull_concurrency(), 1))
+
+        async def pull(chunk):
+            # coroutine pulls and the default pull run concurrently on the event loop, and regular pulls on the pull
+            # pool, so they don't block the event loop
+            async with semaphore:
+                if inspect.iscoroutinefunction(self.pull) or type(self).pull is Attribute.pull:
+                    start = time.time()
+                    result = await self._apull(chunk)
+                    elapsed = time.time() - start
+                else:
+                    result, elapsed = await asyncio.get_running_loop().run_in_executor(
+                        _pull_pool(self.pull_processes()), _timed_pull, self, chunk
+                    )
+                    result = await _awaited(result)
+
+                missing = [item for item in chunk if item not in result]
+                keys = dict(zip(list(result.keys()) + missing, await self._akeys(list(result.keys()) + missing)))
+                for values, expire in self._pulled_values(result, missing, keys, elapsed, len(chunk)):
+                    await self._cache.aset_multi(values, expire=expire)
+
+                return result
+
+        result = {}
+        for chunk_result in await asyncio.gather(*[pull(chunk) for chunk in chunks]):
+            result.update(chunk_result)
+
+        return result
+
+    async def _apull_locked(self, items, stale=None):
+        stale = stale or {}
+        lock_expire = self.lock_expire()
+        if not lock_expire:
+            return await self._apull_and_set(items)
+
+        lock_keys = {_lock_key(key): item for item, key in zip(items, await self._akeys(items))}
+        locked = set(await self._cache.aadd_multi({k: 1 for k in lock_keys.keys()}, lock_expire))
+        result = {}
+        try:
+            locked_items = [item for k, item in lock_keys.items() if k in locked]
+            if len(locked_items) > 0:
+                result.update(await self._apull_and_set(locked_items))
+        finally:
+            if len(locked) > 0:
+                await self._cache.arelease_multi(list(locked))
+
+        waiting = self._waiting(lock_keys, locked, stale, result)
+        deadline = time.time() + self.lock_wait()
+        while len(waiting) > 0 and time.time() < deadline:
+            await asyncio.sleep(_lock_poll)
+            keys = await self._akeys(waiting)
+            released = set(await self._cache.aadd_multi({_lock_key(key): 1 for key in keys}, lock_expire))
+            try:
+                waiting = self._arrived(waiting, keys, await self._cache.aget_multi(keys), result, released)
+            finally:
+                if len(released) > 0:
+                    await self._cache.arelease_multi(list(released))
+
+        if len(waiting) > 0:
+            result.update(await self._apull_and_set(waiting))
+
+        return result
+
+    def _arrived(self, waiting, keys, cached, result, released):
+        # adds items that showed up in the cache to the result, and returns the ones that are still missing. items
+        # whose lock was released without caching anything don't exist
+        remaining = []
+        for item, key in zip(waiting, keys):
+            value, _ = _unwrap(cached.get(key))
+            if isinstance(value, _Missing):
+                continue
+            elif value is not None:
+                result[item] = value
+            elif _lock_key(key) not in released:
+                remaining.append(item)
+
+        return remaining
 
-        # determine which items are missing from the bulk cache get
+    def _chunks(self, items):
+        chunk_size = self.pull_chunk_size()
+        if not chunk_size:
+            return [items]
+
+        return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+    def _classify(self, items, bulk_keys, cached_result):
+        # determine which items are missing from the bulk cache get, should be recomputed early, or should be
+        # refreshed in the background
+        beta = self.early_recompute()
         missed_items = []
+        refresh = {}
+        stale = {}
         for i, item in enumerate(items):
-            if cached_result.get(bulk_keys[i], None) is None:
+            cached = cached_result.get(bulk_keys[i], None)
+            value, recompute = _unwrap(cached, beta)
+            if isinstance(value, _Missing):
+                continue
+
+            stale[item] = value
+            if value is None or recompute:
                 missed_items.append(item)
+            elif _stale(cached):
+                refresh[bulk_keys[i]] = item
+
+        return missed_items, refresh, stale
+
+    def _dirty_keys(self):
+        return [(self.key(item), self.namespace(item)) for item in self.items]
+
+    def _get(self, items, bulk_keys):
+        # perform a bulk get on all of the given keys
+        missed_items, refresh, stale = self._classify(items, bulk_keys, self._cache.get_multi(bulk_keys))
+
+        # serve stale values now, and refresh them in the background
+        if len(refresh) > 0:
+            _refresh(refresh, lambda refresh_items: self._pull_locked(refresh_items, stale))
 
         # if there are no missing items, then we're done
         if len(missed_items) == 0:
-            result = {items[i]: cached_result[bulk_keys[i]] for i, _ in enumerate(items)}
-            if one:
-                if len(result.values()) == 0:
-                    return None
-                return list(result.values())[0]
-            return result
+            return self._merge(items, stale, {})
 
         # pull all of the missing items from ground truth
-        pull_result = self.pull(missed_items)
-        self._cache.set_multi({self.key(k): v for k, v in pull_result.items()}, expire=self.expire())
+        return self._merge(items, stale, self._pull_locked(missed_items, stale))
+
+    def _identity(self):
+        return (self.__class__, frozenset(self.items))
+
+    def _keys(self, items):
+        return _versioned(self._cache, [self.key(item) for item in items], [self.namespace(item) for item in items])
+
+    def _memoized(self, items, bulk_keys):
+        # items that were already fetched during this request don't need to be fetched again
+        result = {}
+        if not kata.memo.active():
+            return result, items, bulk_keys
+
+        remaining = []
+        for item, key in zip(items, bulk_keys):
+            value = kata.memo.get((id(self._cache), key), _unmemoized)
+            if value is _unmemoized:
+                remaining.append((item, key))
+            elif value is not None:
+                result[item] = value
 
+        return result, [item for item, _ in remaining], [key for _, key in remaining]
+
+    def _merge(self, items, stale, pull_result):
         # merge together cached and uncached results
         result = {}
-        for i, item in enumerate(items):
-            if cached_result.get(bulk_keys[i], None) is not None:
-                result[item] = cached_result[bulk_keys[i]]
-            elif item in pull_result.keys():
+        for item in items:
+            if item in pull_result.keys():
                 result[item] = pull_result[item]
+            elif stale.get(item) is not None:
+                result[item] = stale[item]
 
-        if one:
-            if len(result.values()) == 0:
-                return None
-            return list(result.values())[0]
+        return result
+
+    def _pull_and_set(self, items):
+        # each chunk is cached as soon as it's pulled, so callers waiting on other workers see results sooner
+        result = {}
+        for chunk, chunk_result, elapsed in self._pull_chunks(items):
+            missing = [item for item in chunk if item not in chunk_result]
+            keys = dict(zip(list(chunk_result.keys()) + missing, self._keys(list(chunk_result.keys()) + missing)))
+            for values, expire in self._pulled_values(chunk_result, missing, keys, elapsed, len(chunk)):
+                self._cache.set_multi(values, expire=expire)
+            result.update(chunk_result)
+
+        return result
+
+    def _pull_chunks(self, items):
+        # yields each chunk of items along with its pull result and how long it took, as chunks finish. chunks are
+        # pulled on a shared pool, with at most pull_concurrency in flight at a time for this container
+        chunks = self._chunks(items)
+        if len(chunks) == 1 or getattr(_local, 'pulling', False):
+            for chunk in chunks:
+                start = time.time()
+                result = self.pull(chunk)
+                yield chunk, result, time.time() - start
+            return
+
+        executor = _pull_pool(self.pull_processes())
+        concurrency = max(self.pull_concurrency(), 1)
+        pending = {}
+        chunks = iter(chunks)
+        while True:
+            for chunk in itertools.islice(chunks, concurrency - len(pending)):
+                pending[executor.submit(_timed_pull, self, chunk)] = chunk
+
+            if len(pending) == 0:
+                return
+
+            done, _ = concurrent.futures.wait(pending.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield (pending.pop(future),) + future.result()
+
+    def _pull_locked(self, items, stale=None):
+        stale = stale or {}
+        lock_expire = self.lock_expire()
+        if not lock_expire:
+            return self._pull_and_set(items)
+
+        # stampede protection: lock each item, and only pull the items whose lock we got
+        lock_keys = {_lock_key(key): item for item, key in zip(items, self._keys(items))}
+        locked = set(self._cache.add_multi({k: 1 for k in lock_keys.keys()}, lock_expire))
+        result = {}
+        try:
+            locked_items = [item for k, item in lock_keys.items() if k in locked]
+            if len(locked_items) > 0:
+                result.update(self._pull_and_set(locked_items))
+        finally:
+            if len(locked) > 0:
+                self._cache.release_multi(list(locked))
+
+        # for items someone else is pulling, serve stale values or wait for them to show up in the cache
+        waiting = self._waiting(lock_keys, locked, stale, result)
+        deadline = time.time() + self.lock_wait()
+        while len(waiting) > 0 and time.time() < deadline:
+            time.sleep(_lock_poll)
+            keys = self._keys(waiting)
+            released = set(self._cache.add_multi({_lock_key(key): 1 for key in keys}, lock_expire))
+            try:
+                waiting = self._arrived(waiting, keys, self._cache.get_multi(keys), result, released)
+            finally:
+                if len(released) > 0:
+                    self._cache.release_multi(list(released))
+
+        # the other callers are taking too long, so give up and pull anyway
+        if len(waiting) > 0:
+            result.update(self._pull_and_set(waiting))
 
         return result
 
+    def _pulled_values(self, result, missing, keys, elapsed, count):
+        # returns the values to cache for a pull, and their expirations. each item's share of the pull time stands
+        # in for how long it takes to recompute
+        delta = elapsed / max(count, 1)
+        values = [({keys[k]: self._wrap(v, delta) for k, v in result.items()}, self.expire())]
+
+        # items that pull didn't return don't exist, so cache that too
+        missing_expire = self.missing_expire()
+        if missing_expire and len(missing) > 0:
+            values.append(({keys[item]: _missing for item in missing}, missing_expire))
+
+        return values
+
+    def _remember(self, items, bulk_keys, fetched):
+        for item, key in zip(items, bulk_keys):
+            kata.memo.set((id(self._cache), key), fetched.get(item))
+
+    def _waiting(self, lock_keys, locked, stale, result):
+        # items someone else is pulling are served stale if possible, and otherwise need to be waited on
+        waiting = []
+        for k, item in lock_keys.items():
+            if k in locked:
+                continue
+            if stale.get(item) is not None:
+                result[item] = stale[item]
+            else:
+                waiting.append(item)
+
+        return waiting
+
+    async def aget(self, one=None):
+        if one is None and self._one:
+            one = True
+
+        items = list(self.items)
+        result, items, bulk_keys = self._memoized(items, await self._akeys(items))
+        if len(items) > 0:
+            fetched = await self._aget(items, bulk_keys)
+            self._remember(items, bulk_keys, fetched)
+            result.update(fetched)
+
+        return _one(result) if one else result
+
+    async def aget_one(self):
+        return await self.aget(one=True)
+
+    def attribute(self):
+        raise NotImplementedError()
+
+    def get(self, one=None):
+        if one is None and self._one:
+            one = True
+
+        items = list(self.items)
+        result, items, bulk_keys = self._memoized(items, self._keys(items))
+        if len(items) > 0:
+            fetched = self._get(items, bulk_keys)
+            self._remember(items, bulk_keys, fetched)
+            result.update(fetched)
+
+        return _one(result) if one else result
+
     def key(self, item):
         raise NotImplementedError()
 
+    def namespace(self, item):
+        return None
+
     def get_one(self):
         return self.get(one=True)
 
     def pull(self, items):
         model, column = self.attribute()
         return {getattr(e, column): e for e in model.get(where_in=(column, items))}
+
+    def pull_chunk_size(self):
+        return 0
+
+    def pull_concurrency(self):
+        return 4
+
+    def pull_processes(self):
+        return False
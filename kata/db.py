@@ -1,25 +1,62 @@
+import base64
+import collections
 import contextlib
 import datetime
 import decimal
+import functools
+import io
+import itertools
 import json
 import logging
 import msgpack
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 import psycopg2.pool
+import re
+import threading
+import time
+import uuid
+import weakref
 
+import kata.adb
 import kata.cache
-
+import kata.memo
+import kata.stats
+
+_column_dtypes = {
+    16: 'bool',
+    20: 'int64',
+    21: 'int64',
+    23: 'int64',
+    700: 'float64',
+    701: 'float64',
+    1082: 'datetime64[D]',
+    1114: 'datetime64[us]',
+    1184: 'datetime64[us]',
+    1700: 'float64',
+}
+_compact_classes = {}
+_local = threading.local()
+_locking = re.compile(r'\bfor\s+(no\s+key\s+update|update|key\s+share|share)\b', re.IGNORECASE)
+_unmemoized = object()
 _pool = None
-
-def initialize(config):
-    global _pool
-    if _pool:
-        return
-
-    _pool = psycopg2.pool.ThreadedConnectionPool(
+_prepared = weakref.WeakKeyDictionary()
+_prepared_limit = 0
+_prepared_names = itertools.count()
+_replica_busy = collections.Counter()
+_replica_ejected = {}
+_replica_lock = threading.Lock()
+_replica_retry = 30
+_replica_strategy = 'round_robin'
+_replica_turn = itertools.count()
+_replicas = []
+_where_in_chunk_size = 10000
+
+def _create_pool(config, minconn):
+    return psycopg2.pool.ThreadedConnectionPool(
         database=config.get('name', ''),
-        minconn=1,
+        minconn=minconn,
         maxconn=config.get('pool_size', 10),
         host=config.get('host', 'localhost'),
         password=config.get('password', ''),
@@ -27,9 +64,58 @@ def initialize(config):
         user=config.get('user', '')
     )
 
+def initialize(config):
+    global _pool, _prepared_limit, _replica_retry, _replica_strategy, _replicas, _where_in_chunk_size
+    if _pool:
+        return
+
+    _prepared_limit = config.get('prepared_statements', 0)
+    _where_in_chunk_size = config.get('where_in_chunk_size', 10000)
+    _replica_retry = config.get('replica_retry', 30)
+    _replica_strategy = config.get('replica_strategy', 'round_robin')
+
+    _pool = _create_pool(config, 1)
+
+    # replicas inherit any settings they don't override from the primary, and connect lazily so that one being down
+    # doesn't prevent the app from starting
+    _replicas = []
+    for replica in config.get('replicas', []):
+        if not isinstance(replica, dict):
+            host_parts = str(replica).split(':')
+            replica = {'host': host_parts[0]}
+            if len(host_parts) > 1:
+                replica['port'] = int(host_parts[1])
+
+        replica_config = dict(config)
+        replica_config.update(replica)
+        _replicas.append(_create_pool(replica_config, 0))
+
     execute('create extension if not exists "uuid-ossp"')
 
+class _Array(list):
+    pass
+
+def _adapt_array(array):
+    # send arrays as untyped literals so postgres casts them to the column's type, like it would for a plain value
+    return psycopg2.extensions.QuotedString(_array_literal(array))
+
+def _array_literal(array):
+    elements = []
+    for e in array:
+        if e is None:
+            elements.append('NULL')
+        elif isinstance(e, list):
+            elements.append(_array_literal(e))
+        else:
+            elements.append('"' + str(e).replace('\\', '\\\\').replace('"', '\\"') + '"')
+
+    return '{' + ','.join(elements) + '}'
+
+psycopg2.extensions.register_adapter(_Array, _adapt_array)
+
 class Object(object):
+    __compact__ = False
+    __columns__ = None
     __table__ = ''
 
     def __init__(self, *args, **kwargs):
@@ -37,15 +123,22 @@ class Object(object):
             setattr(self, k, v)
 
     @classmethod
-    def create(cls, data, unique=None, debug=False):
-        one = False
-        if not isinstance(data, list):
-            data = [data]
-            one = True
-
-        if len(data) == 0:
-            return
+    def _delete(cls, where=None, where_in=None):
+        # without any conditions, a delete would empty the whole table
+        where = where or {}
+        if not where and not _where_in_list(where_in):
+            raise ValueError('Cannot delete from %s without conditions' % cls.__table__)
+
+        return [
+            (
+                _delete_sql(cls.__table__, tuple(where.keys()), tuple(column for column, _ in chunk)),
+                list(where.values()) + [_Array(values) for _, values in chunk]
+            )
+            for chunk in _where_in_chunks(where_in)
+        ]
 
+    @classmethod
+    def _insert(cls, data, unique=None):
         fields = ' (%s)' % ','.join(sorted(data[0].keys()))
         values = ' values ' + ','.join([
             '(%s)' % ','.join(['%s'] * len(data[0]))
@@ -53,27 +146,33 @@ class Object(object):
         returning = ' returning id'
         args = [i[1] for j in data for i in sorted(j.items())]
 
-        # handle unique indexes
-        unique_string = ''
-        if unique:
-            # if no columns are given, then update all columns
-            unique_columns = unique
-            if not isinstance(unique_columns, tuple) and not isinstance(unique_columns, list):
-                unique_columns = [unique_columns]
-
-            update_columns = data[0].keys()
-            if isinstance(unique, dict):
-                unique_columns = unique['columns']
-                update_columns = unique.get('update', [])
-
-            unique_string = ' on conflict (%s) do update set %s' % (
-                ','.join(unique_columns),
-                ', '.join(['%s = excluded.%s' % (column, column) for column in update_columns])
-            )
-
+        unique_string = _unique_string(unique, data[0].keys())
         sql = 'insert into "' + cls.__table__ + '"' + fields + values + unique_string + returning
-        row_ids = query(sql, args, debug)
+        return sql, args
+
+    @classmethod
+    def _objects(cls, rows, one=False, columns=None):
+        # return a single item rather than the entire list
+        if one:
+            if len(rows) == 0:
+                return None
+            return cls._objects(rows[:1], columns=columns)[0]
+
+        if cls.__compact__ and columns is None and len(rows) > 0:
+            columns = tuple(rows[0].keys())
+            rows = [row.values() for row in rows]
+
+        if columns is None:
+            return [cls(**row) for row in rows]
 
+        row_cls = _compact_class(cls, columns)
+        if row_cls is None:
+            return [cls(**dict(zip(columns, row))) for row in rows]
+
+        return [_compact_object(row_cls, row) for row in rows]
+
+    @classmethod
+    def _returned(cls, data, row_ids, one=False):
         # add the last insert ID so the returned object has an ID
         if one:
             data = data[0]
@@ -87,88 +186,223 @@ class Object(object):
             return result
 
     @classmethod
-    def delete(cls, where=None, where_in=None, debug=False):
-        # construct where clause
-        where_string = ' where '
-        args = []
+    def _rows(cls, sql, args, debug=False):
+        # compact models are built from plain tuples, skipping the dictionary for each row
+        if cls.__compact__:
+            return _query_tuples(sql, args, debug, prepare=True)
 
-        if where:
-            where_string += ' and '.join([e + ' = %s' for e in where.keys()])
-            args = [e[1] for e in where.items()]
+        return None, query(sql, args, debug, prepare=True)
 
-        if where_in:
-            if not isinstance(where_in, list):
-                where_in = [where_in]
+    @classmethod
+    def _select(cls, where=None, where_in=None, fields=None, order_by=None, limit=None, offset=None, after=None):
+        where = where or {}
+        where_in = _where_in_list(where_in)
+        args = list(where.values()) + [_Array(values) for _, values in where_in]
+
+        # after is a tuple of (columns, values, descending) for keyset pagination
+        keyset = None
+        if after is not None:
+            keyset = (tuple(after[0]), after[2])
+            args += list(after[1])
+
+        args += [e for e in (limit, offset) if e is not None]
+
+        sql = _select_sql(
+            cls.__table__,
+            tuple(fields) if fields is not None else None,
+            tuple(where.keys()),
+            tuple(column for column, _ in where_in),
+            order_by,
+            limit is not None,
+            offset is not None,
+            keyset
+        )
 
-            if where and len(where) == 1:
-                where_string += ' and '
+        return sql, args
 
-            for where_in_row in where_in:
-                column, values = where_in_row
-                where_string += column + ' in (' + ','.join(["'%s'" % e if isinstance(e, str) else str(e) for e in values]) + ')'
+    @classmethod
+    def _selects(cls, where=None, where_in=None, fields=None, order_by=None, limit=None, offset=None):
+        # very large where in lists are split across several queries, which is only safe without ordering or paging
+        chunks = [where_in]
+        if order_by is None and limit is None and offset is None:
+            chunks = _where_in_chunks(where_in)
 
-        sql = 'delete from "' + cls.__table__ + '"' + where_string
-        execute(sql, args, debug)
+        return [cls._select(where, chunk, fields, order_by, limit, offset) for chunk in chunks]
 
     @classmethod
-    def execute(cls, sql, args=None, placeholder='__table__', debug=False):
-        return execute(sql.replace(placeholder, cls.__table__), args, debug)
-
-    def fields(self):
-        return self.__dict__
+    def _update(cls, data, where=None):
+        where = where or {}
+        sql = _update_sql(cls.__table__, tuple(data[0].keys()), tuple(where.keys()))
+        args = list(data[0].values()) + list(where.values())
+        return sql, args
 
     @classmethod
-    def get(cls, where=None, where_in=None, fields=None, one=False, order_by=None, limit=None, offset=None, debug=False):
-        columns = '*'
-        if fields is not None:
-            columns = ','.join(fields)
+    async def acreate(cls, data, unique=None, debug=False):
+        one = False
+        if not isinstance(data, list):
+            data = [data]
+            one = True
 
-        # construct order by clause
-        order = ' '
-        if order_by is not None:
-            order += 'order by %s' % order_by
-        if limit is not None:
-            order += ' limit %s ' % limit
-        if offset is not None:
-            order += ' offset %s ' % offset
+        if len(data) == 0:
+            return
 
-        # construct where clause
-        where_string = ''
-        args = []
+        sql, args = cls._insert(data, unique)
+        return cls._returned(data, await kata.adb.query(sql, args, debug), one)
 
-        if where or where_in:
-            where_string += ' where '
+    @classmethod
+    async def adelete(cls, where=None, where_in=None, debug=False):
+        for sql, args in cls._delete(where, where_in):
+            await kata.adb.execute(sql, args, debug)
 
-        if where:
-            where_string += ' and '.join([e + ' = %s' for e in where.keys()])
-            args = [e[1] for e in where.items()]
+    @classmethod
+    async def aexecute(cls, sql, args=None, placeholder='__table__', debug=False):
+        return await kata.adb.execute(sql.replace(placeholder, cls.__table__), args, debug)
 
-        if where_in:
-            if not isinstance(where_in, list):
-                where_in = [where_in]
+    @classmethod
+    async def aget(cls, where=None, where_in=None, fields=None, one=False, order_by=None, limit=None, offset=None,
+                   debug=False):
+        rows = []
+        for sql, args in cls._selects(where, where_in, fields, order_by, limit, offset):
+            rows += await kata.adb.query(sql, args, debug)
 
-            if where and len(where) >= 1:
-                where_string += ' and '
+        return cls._objects(rows, one)
 
-            where_string += ' and '.join([
-                column + ' in (' + ','.join(["'%s'" % e if isinstance(e, str) else str(e) for e in values]) + ')'
-                for (column, values) in where_in
-            ])
+    @classmethod
+    async def aquery(cls, sql, args=None, placeholder='__table__', debug=False):
+        return await kata.adb.query(sql.replace(placeholder, cls.__table__), args, debug)
+
+    @classmethod
+    async def aupdate(cls, data, where=None, debug=False):
+        one = False
+        if not isinstance(data, list):
+            data = [data]
+            one = True
 
-        # execute query
-        sql = 'select ' + columns + ' from ' + cls.__table__ + where_string + order
-        rows = query(sql, args, debug)
+        if len(data) == 0:
+            return
 
-        if rows is None:
-            return None
+        sql, args = cls._update(data, where)
+        return cls._returned(data, await kata.adb.query(sql, args, debug), one)
 
-        # return a single item rather than the entire list
-        if one:
-            if len(rows) == 0:
+    @classmethod
+    def bulk_create(cls, rows, unique=None, returning_ids=False, chunk_size=10000, debug=False):
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return [] if returning_ids else None
+
+        columns = sorted(first.keys())
+        rows = itertools.chain([first], rows)
+        kata.memo.clear()
+        table = '"' + cls.__table__ + '"'
+
+        # upserts and returned IDs can't be done by copy itself, so copy into a staging table and insert from there
+        staging = unique or returning_ids
+        target = table
+        with get_cursor() as cursor:
+            if staging:
+                target = '"_kata_staging_' + uuid.uuid4().hex + '"'
+                sql = 'create temporary table ' + target + ' on commit drop as select ' + ','.join(columns) + \
+                    ' from ' + table + ' with no data'
+                logging.debug('Running SQL: ' + sql)
+                if debug:
+                    print('Running SQL: ' + sql)
+                cursor.execute(sql)
+
+            sql = 'copy ' + target + ' (' + ','.join(columns) + ') from stdin'
+            logging.debug('Running SQL: ' + sql)
+            if debug:
+                print('Running SQL: ' + sql)
+
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    break
+
+                cursor.copy_expert(sql, io.StringIO(''.join([
+                    '\t'.join([_copy_value(row.get(column)) for column in columns]) + '\n'
+                    for row in chunk
+                ])))
+
+            if not staging:
                 return None
-            return cls(**rows[0])
 
-        return [cls(**row) for row in rows]
+            sql = 'insert into ' + table + ' (' + ','.join(columns) + ') select ' + ','.join(columns) + ' from ' + \
+                target + _unique_string(unique, columns)
+            if returning_ids:
+                sql += ' returning id'
+
+            logging.debug('Running SQL: ' + sql)
+            if debug:
+                print('Running SQL: ' + sql)
+            cursor.execute(sql)
+
+            if returning_ids:
+                return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def create(cls, data, unique=None, debug=False):
+        one = False
+        if not isinstance(data, list):
+            data = [data]
+            one = True
+
+        if len(data) == 0:
+            return
+
+        sql, args = cls._insert(data, unique)
+        return cls._returned(data, query(sql, args, debug), one)
+
+    @classmethod
+    def delete(cls, where=None, where_in=None, debug=False):
+        # a large where_in is split into several statements, which should still succeed or fail together
+        with transaction():
+            for sql, args in cls._delete(where, where_in):
+                execute(sql, args, debug, prepare=True)
+
+    @classmethod
+    def execute(cls, sql, args=None, placeholder='__table__', debug=False):
+        return execute(sql.replace(placeholder, cls.__table__), args, debug)
+
+    def fields(self):
+        if self.__columns__ is None:
+            return self.__dict__
+
+        result = {column: getattr(self, column) for column in self.__columns__}
+        result.update(getattr(self, '__dict__', {}))
+        return result
+
+    @classmethod
+    def get(cls, where=None, where_in=None, fields=None, one=False, order_by=None, limit=None, offset=None, debug=False,
+            as_columns=False):
+        if as_columns:
+            import numpy
+            chunks = [query_columns(sql, args, debug=debug) for sql, args in cls._selects(
+                where, where_in, fields, order_by, limit, offset
+            )]
+
+            return {column: numpy.concatenate([chunk[column] for chunk in chunks]) for column in chunks[0].keys()}
+
+        # identical gets during the same request only run once
+        selects = cls._selects(where, where_in, fields, order_by, limit, offset)
+        memo_key = None
+        if kata.memo.active():
+            memo_key = (cls, one, repr(selects))
+            result = kata.memo.get(memo_key, _unmemoized)
+            if result is not _unmemoized:
+                return list(result) if isinstance(result, list) else result
+
+        rows = []
+        columns = None
+        for sql, args in selects:
+            columns, chunk = cls._rows(sql, args, debug)
+            rows += chunk
+
+        result = cls._objects(rows, one, columns)
+        if memo_key is not None:
+            kata.memo.set(memo_key, list(result) if isinstance(result, list) else result)
+
+        return result
 
     @classmethod
     def get_one(cls, where=None, where_in=None, fields=None, order_by=None, limit=None, offset=None, debug=False):
@@ -184,8 +418,42 @@ class Object(object):
         )
 
     @classmethod
-    def query(cls, sql, args=None, placeholder='__table__', debug=False):
-        return query(sql.replace(placeholder, cls.__table__), args, debug)
+    def iter(cls, where=None, where_in=None, fields=None, order_by=None, limit=None, offset=None, batch_size=1000,
+             debug=False):
+        sql, args = cls._select(where, where_in, fields, order_by, limit, offset)
+        for row in stream(sql, args, batch_size, debug):
+            yield cls._objects([row], one=True)
+
+    @classmethod
+    def page(cls, where=None, where_in=None, fields=None, order_by='id', after=None, limit=50, descending=False,
+             debug=False):
+        order_by = tuple(order_by) if isinstance(order_by, (list, tuple)) else (order_by,)
+        if fields is not None:
+            fields = list(fields) + [column for column in order_by if column not in fields]
+
+        # rather than an offset, continue from the sort key of the last row on the previous page, so every page can
+        # be read from an index no matter how deep it is
+        keyset = None
+        if after is not None:
+            keyset = (order_by, _decode_token(after), descending)
+
+        # fetch one extra row to find out if there's another page
+        direction = ' desc' if descending else ' asc'
+        sql, args = cls._select(
+            where, where_in, fields, ', '.join([column + direction for column in order_by]), limit + 1, None, keyset
+        )
+
+        columns, rows = cls._rows(sql, args, debug)
+        rows = cls._objects(rows, columns=columns)
+        if len(rows) <= limit:
+            return rows, None
+
+        rows = rows[:limit]
+        return rows, _encode_token([getattr(rows[-1], column) for column in order_by])
+
+    @classmethod
+    def query(cls, sql, args=None, placeholder='__table__', debug=False, replica=True):
+        return query(sql.replace(placeholder, cls.__table__), args, debug, replica=replica)
 
     @classmethod
     def truncate(cls, restart_identity=True):
@@ -205,41 +473,308 @@ class Object(object):
         if len(data) == 0:
             return
 
-        if not where:
-            where = {}
+        sql, args = cls._update(data, where)
+        return cls._returned(data, query(sql, args, debug, prepare=True), one)
+
+def _compact_class(cls, columns):
+    key = (cls, columns)
+    if key in _compact_classes:
+        return _compact_classes[key]
+
+    # columns that can't be used as slots fall back to a regular instance
+    row_cls = None
+    if len(set(columns)) == len(columns) and all(column.isidentifier() for column in columns):
+        row_cls = type(cls.__name__, (cls,), {
+            '__columns__': columns,
+            '__module__': cls.__module__,
+            '__qualname__': cls.__qualname__,
+            '__reduce__': _compact_reduce,
+            '__slots__': columns,
+        })
+
+    _compact_classes[key] = row_cls
+    return row_cls
+
+def _compact_object(row_cls, row):
+    result = row_cls.__new__(row_cls)
+    for column, value in zip(row_cls.__columns__, row):
+        setattr(result, column, value)
+
+    return result
+
+def _compact_reduce(self):
+    # compact classes are created at runtime and can't be found by name, so pickle them as their model and columns
+    cls = type(self).__mro__[1]
+    return (
+        _compact_unpickle,
+        (cls, self.__columns__, tuple(getattr(self, column) for column in self.__columns__)),
+        getattr(self, '__dict__', None) or None
+    )
 
-        where_string = ''
-        if where:
-            where_string += ' where '
+def _compact_unpickle(cls, columns, row):
+    return _compact_object(_compact_class(cls, columns), row)
+
+def _column_array(values, type_code):
+    import numpy
+
+    dtype = _column_dtypes.get(type_code, 'object')
+    if None in values:
+        # ints don't have a missing value, so columns with nulls become floats with nan, and nulls in booleans are
+        # kept as objects. numpy already treats None as NaT for timestamps
+        if dtype == 'int64':
+            dtype = 'float64'
+        elif dtype == 'bool':
+            dtype = 'object'
+
+    # numpy timestamps don't have a timezone, so normalize to UTC
+    if type_code == 1184:
+        values = [e.astimezone(datetime.timezone.utc).replace(tzinfo=None) if e is not None else None for e in values]
+
+    return numpy.array(values, dtype=dtype)
+
+def _connection(replica):
+    if replica and _replicas and not getattr(_local, 'primary', 0):
+        for pool in _replica_order():
+            if _replica_ejected.get(pool, 0) > time.time():
+                continue
+
+            try:
+                return pool, pool.getconn()
+            except psycopg2.pool.PoolError:
+                continue
+            except psycopg2.OperationalError:
+                logging.warning('Ejecting database replica for %s seconds' % _replica_retry)
+                kata.stats.increment('db.replica.ejected')
+                _replica_ejected[pool] = time.time() + _replica_retry
+
+    return _pool, _pool.getconn()
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+
+    if isinstance(value, bool):
+        value = 't' if value else 'f'
+    elif isinstance(value, (datetime.date, datetime.datetime)):
+        value = value.isoformat()
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        value = '\\x' + bytes(value).hex()
+    elif isinstance(value, list):
+        # lists are arrays, like they are when psycopg2 binds them
+        value = _array_literal(value)
+    elif isinstance(value, dict):
+        value = json.dumps(value)
+    else:
+        value = str(value)
+
+    # escape characters that have a special meaning in copy's text format
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def _decode_token(token):
+    def decode(obj):
+        if 'date' in obj:
+            return datetime.date.fromisoformat(obj['date'])
+        if 'datetime' in obj:
+            return datetime.datetime.fromisoformat(obj['datetime'])
+        if 'decimal' in obj:
+            return decimal.Decimal(obj['decimal'])
+        if 'uuid' in obj:
+            return uuid.UUID(obj['uuid'])
 
-        returning = ' returning id'
-        update = ','.join([e + ' = %s' for e in data[0].keys()])
-        where_string += ' and '.join([e + ' = %s' for e in where.keys()])
-        args = list(data[0].values()) + list(where.values())
+        return obj
 
-        sql = 'update "' + cls.__table__ + '"' + ' set ' + update + where_string + returning
-        row_ids = query(sql, args, debug)
+    data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    return json.loads(data.decode('utf-8'), object_hook=decode)
 
-        # add the last insert ID so the returned object has an ID
-        if one:
-            data = data[0]
-            data['id'] = row_ids[0][0]
-            return cls(**data)
-        else:
-            result = []
-            for row, row_id in zip(data, row_ids):
-                row['id'] = row_id[0]
-                result.append(cls(**row))
-            return result
+@functools.lru_cache(maxsize=1024)
+def _delete_sql(table, where_columns, where_in_columns):
+    return 'delete from "' + table + '"' + _where_string(where_columns, where_in_columns)
+
+def _encode_token(values):
+    def encode(obj):
+        if isinstance(obj, datetime.datetime):
+            return {'datetime': obj.isoformat()}
+        if isinstance(obj, datetime.date):
+            return {'date': obj.isoformat()}
+        if isinstance(obj, decimal.Decimal):
+            return {'decimal': str(obj)}
+        if isinstance(obj, uuid.UUID):
+            return {'uuid': str(obj)}
+
+        raise TypeError('Cannot use %s in a page token' % type(obj).__name__)
+
+    data = json.dumps(values, default=encode, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+def _execute(cursor, sql, args, debug, prepare):
+    logging.debug('Running SQL: ' + str((sql, args)))
+    if debug:
+        print('Running SQL: ' + str((sql, args)))
+
+    # anything remembered for the current request might be out of date after a write
+    if not _is_read(sql):
+        kata.memo.clear()
+
+    if not prepare or not _prepared_limit:
+        cursor.execute(sql, args)
+        return
+
+    # prepared statements belong to a single session, so track them separately for each pooled connection
+    statements = _prepared.setdefault(cursor.connection, collections.OrderedDict())
+    name = statements.get(sql)
+    if name is None:
+        kata.stats.increment('db.prepared.miss')
+        name = 'kata_%s' % next(_prepared_names)
+        cursor.execute('prepare ' + name + ' as ' + _positional(sql))
+        statements[sql] = name
+
+        if len(statements) > _prepared_limit:
+            _, evicted = statements.popitem(last=False)
+            cursor.execute('deallocate ' + evicted)
+    else:
+        kata.stats.increment('db.prepared.hit')
+        statements.move_to_end(sql)
+
+    if args:
+        cursor.execute('execute ' + name + ' (' + ','.join(['%s'] * len(args)) + ')', args)
+    else:
+        cursor.execute('execute ' + name)
+
+def _is_read(sql):
+    # locking reads have to run on the primary
+    return sql.lstrip()[:6].lower() == 'select' and not _locking.search(sql)
+
+def _positional(sql):
+    # convert psycopg2 placeholders into the $1, $2, ... placeholders expected by prepare
+    counter = itertools.count(1)
+    return re.sub(r'%([%s])', lambda match: '%' if match.group(1) == '%' else '$%s' % next(counter), sql)
+
+def _query_tuples(sql, args=None, debug=False, prepare=False):
+    with get_cursor(replica=_is_read(sql), cursor_factory=None) as cursor:
+        _execute(cursor, sql, args, debug, prepare)
+        return tuple(e[0] for e in cursor.description), cursor.fetchall()
+
+def _replica_order():
+    if _replica_strategy == 'least_busy':
+        return sorted(_replicas, key=lambda pool: _replica_busy[pool])
+
+    start = next(_replica_turn) % len(_replicas)
+    return _replicas[start:] + _replicas[:start]
+
+@functools.lru_cache(maxsize=1024)
+def _select_sql(table, fields, where_columns, where_in_columns, order_by, limit, offset, keyset=None):
+    columns = '*'
+    if fields is not None:
+        columns = ','.join(fields)
+
+    # construct order by clause
+    order = ' '
+    if order_by is not None:
+        order += 'order by %s' % order_by
+    if limit:
+        order += ' limit %s '
+    if offset:
+        order += ' offset %s '
+
+    return 'select ' + columns + ' from ' + table + _where_string(where_columns, where_in_columns, keyset) + order
+
+def _unique_string(unique, columns):
+    if not unique:
+        return ''
+
+    # if no columns are given, then update all columns
+    unique_columns = unique
+    if not isinstance(unique_columns, tuple) and not isinstance(unique_columns, list):
+        unique_columns = [unique_columns]
+
+    update_columns = columns
+    if isinstance(unique, dict):
+        unique_columns = unique['columns']
+        update_columns = unique.get('update', [])
+
+    return ' on conflict (%s) do update set %s' % (
+        ','.join(unique_columns),
+        ', '.join(['%s = excluded.%s' % (column, column) for column in update_columns])
+    )
+
+@functools.lru_cache(maxsize=1024)
+def _update_sql(table, columns, where_columns):
+    sql = 'update "' + table + '"' + ' set ' + ','.join([e + ' = %s' for e in columns])
+    if where_columns:
+        sql += ' where ' + ' and '.join([e + ' = %s' for e in where_columns])
+
+    return sql + ' returning id'
+
+def _where_in_chunks(where_in):
+    where_in = _where_in_list(where_in)
+    if not where_in:
+        return [where_in]
+
+    # only the longest list is split, and every other condition is repeated for each chunk
+    index = max(range(len(where_in)), key=lambda i: len(where_in[i][1]))
+    column, values = where_in[index]
+    values = list(values)
+    if len(values) <= _where_in_chunk_size:
+        return [where_in]
+
+    return [
+        where_in[:index] + [(column, values[i:i + _where_in_chunk_size])] + where_in[index + 1:]
+        for i in range(0, len(values), _where_in_chunk_size)
+    ]
+
+def _where_in_list(where_in):
+    if not where_in:
+        return []
+
+    if not isinstance(where_in, list):
+        return [where_in]
+
+    return where_in
+
+def _where_string(where_columns, where_in_columns, keyset=None):
+    conditions = [e + ' = %s' for e in where_columns] + [e + ' = any(%s)' for e in where_in_columns]
+
+    # compare sort keys as a row, so postgres can seek to the position in a multi-column index
+    if keyset:
+        columns, descending = keyset
+        conditions.append('(%s) %s (%s)' % (
+            ','.join(columns),
+            '<' if descending else '>',
+            ','.join(['%s'] * len(columns))
+        ))
+
+    if not conditions:
+        return ''
+
+    return ' where ' + ' and '.join(conditions)
 
 @contextlib.contextmanager
-def get_cursor():
-    connection = _pool.getconn()
+def get_cursor(name=None, replica=False, cursor_factory=psycopg2.extras.DictCursor):
+    # inside of a transaction, every statement uses the pinned connection and is committed along with it
+    connection = getattr(_local, 'connection', None)
+    if connection is not None:
+        yield connection.cursor(name=name, cursor_factory=cursor_factory)
+        return
+
+    pool, connection = _connection(replica)
+    with _replica_lock:
+        _replica_busy[pool] += 1
     try:
-        yield connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        yield connection.cursor(name=name, cursor_factory=cursor_factory)
         connection.commit()
     finally:
-        _pool.putconn(connection)
+        with _replica_lock:
+            _replica_busy[pool] -= 1
+        pool.putconn(connection)
+
+@contextlib.contextmanager
+def primary():
+    # reads inside of this block go to the primary, so they see any writes that haven't reached the replicas yet
+    _local.primary = getattr(_local, 'primary', 0) + 1
+    try:
+        yield
+    finally:
+        _local.primary -= 1
 
 def serialize(data, format='json', pretty=False):
     def encode(obj):
@@ -265,17 +800,112 @@ def serialize(data, format='json', pretty=False):
 
     return data
 
-def execute(sql, args=None, debug=False):
+def execute(sql, args=None, debug=False, prepare=False):
     with get_cursor() as cursor:
+        _execute(cursor, sql, args, debug, prepare)
+
+def query(sql, args=None, debug=False, prepare=False, replica=True):
+    # selects that write, like calls to functions with side effects, can opt out of replicas with replica=False
+    with get_cursor(replica=replica and _is_read(sql)) as cursor:
+        _execute(cursor, sql, args, debug, prepare)
+        return cursor.fetchall()
+
+def on_commit(fn):
+    # inside of a transaction, fn runs once it commits, and is dropped if it rolls back
+    if getattr(_local, 'connection', None) is None:
+        fn()
+        return
+
+    _local.on_commit.append(fn)
+
+@contextlib.contextmanager
+def transaction():
+    connection = getattr(_local, 'connection', None)
+
+    # nested transactions become savepoints, so an exception only rolls back the inner block
+    if connection is not None:
+        _local.savepoints += 1
+        savepoint = 'kata_savepoint_%s' % _local.savepoints
+        callbacks = len(_local.on_commit)
+        cursor = connection.cursor()
+        cursor.execute('savepoint ' + savepoint)
+        try:
+            yield
+        except Exception:
+            cursor.execute('rollback to savepoint ' + savepoint)
+            del _local.on_commit[callbacks:]
+            kata.memo.clear()
+            raise
+        else:
+            cursor.execute('release savepoint ' + savepoint)
+        finally:
+            _local.savepoints -= 1
+
+        return
+
+    connection = _pool.getconn()
+    _local.connection = connection
+    _local.on_commit = []
+    _local.savepoints = 0
+    try:
+        yield
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        kata.memo.clear()
+        raise
+    finally:
+        _local.connection = None
+        _pool.putconn(connection)
+
+    # callbacks run after the connection is released, so they can use the database themselves
+    callbacks, _local.on_commit = _local.on_commit, []
+    for callback in callbacks:
+        callback()
+
+def query_columns(sql, args=None, batch_size=10000, debug=False):
+    import numpy
+
+    # fetch from a named cursor in batches, converting each batch into one array per column
+    with get_cursor(name='kata_columns_' + uuid.uuid4().hex, replica=_is_read(sql), cursor_factory=None) as cursor:
         logging.debug('Running SQL: ' + str((sql, args)))
         if debug:
             print('Running SQL: ' + str((sql, args)))
         cursor.execute(sql, args)
 
-def query(sql, args=None, debug=False):
-    with get_cursor() as cursor:
+        batches = None
+        while True:
+            rows = cursor.fetchmany(batch_size)
+
+            # named cursors only have a description once something has been fetched
+            if batches is None:
+                columns = [e[0] for e in cursor.description]
+                type_codes = [e[1] for e in cursor.description]
+                batches = [[] for _ in columns]
+
+            if not rows:
+                break
+
+            for i, values in enumerate(zip(*rows)):
+                batches[i].append(_column_array(values, type_codes[i]))
+
+        return {
+            column: numpy.concatenate(batch) if batch else _column_array((), type_code)
+            for column, type_code, batch in zip(columns, type_codes, batches)
+        }
+
+def stream(sql, args=None, batch_size=1000, debug=False):
+    # a named cursor keeps the result set on the server, so only one batch is held in memory at a time
+    with get_cursor(name='kata_stream_' + uuid.uuid4().hex, replica=_is_read(sql)) as cursor:
         logging.debug('Running SQL: ' + str((sql, args)))
         if debug:
             print('Running SQL: ' + str((sql, args)))
         cursor.execute(sql, args)
-        return cursor.fetchall()
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+
+            for row in rows:
+                yield row
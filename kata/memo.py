@@ -0,0 +1,33 @@
+import contextlib
+import contextvars
+
+_memo = contextvars.ContextVar('kata_memo', default=None)
+
+def active():
+    return _memo.get() is not None
+
+def clear():
+    memo = _memo.get()
+    if memo is not None:
+        memo.clear()
+
+def get(key, default=None):
+    memo = _memo.get()
+    if memo is None:
+        return default
+
+    return memo.get(key, default)
+
+@contextlib.contextmanager
+def scope():
+    # values are remembered until the end of the block, and each thread or task gets its own
+    token = _memo.set({})
+    try:
+        yield
+    finally:
+        _memo.reset(token)
+
+def set(key, value):
+    memo = _memo.get()
+    if memo is not None:
+        memo[key] = value
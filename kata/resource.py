@@ -1,7 +1,9 @@
+import contextlib
 import falcon
 import json
 import msgpack
 import kata.db
+import kata.memo
 import kata.stats
 
 class Result(object):
@@ -13,6 +15,7 @@ class Result(object):
 class Resource(object):
     format = 'json'
     log = ''
+    memo = False
     __type__ = 'resource'
 
     def __init__(self, format=None):
@@ -33,7 +36,10 @@ class Resource(object):
             overall_timer = kata.stats.start_timer(
                 'speed.%s.%s.all' % (self.__class__.__type__, request_type)
             )
-            result = getattr(self, request_type)(request, response, *args, **kwargs)
+
+            # repeated container and object gets are only fetched once per request
+            with kata.memo.scope() if self.__class__.memo else contextlib.nullcontext():
+                result = getattr(self, request_type)(request, response, *args, **kwargs)
 
             # log resource timing
             kata.stats.stop_timer(resource_timer)
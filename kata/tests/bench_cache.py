@@ -0,0 +1,57 @@
+import datetime
+import decimal
+import time
+import kata.cache
+import kata.db
+
+class Row(kata.db.Object):
+    __table__ = 'row'
+
+def _payloads():
+    # shaped like the values containers cache: a single row, and attribute results keyed by id
+    def row(i):
+        return Row(
+            id=i,
+            user_id=i * 7,
+            name='name %s' % i,
+            description='a somewhat longer description for row %s ' % i * 3,
+            score=decimal.Decimal('%s.25' % i),
+            created_dt=datetime.datetime(2020, 1, 1) + datetime.timedelta(minutes=i),
+        )
+
+    return {
+        'row': row(1),
+        'attribute_100': {i: row(i) for i in range(100)},
+        'list_1000': [row(i) for i in range(1000)],
+    }
+
+def _time(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def run(iterations=200):
+    settings = [
+        ('pickle', None),
+        ('pickle', 'zlib'),
+        ('msgpack', None),
+        ('msgpack', 'zlib'),
+    ]
+
+    try:
+        import lz4.frame
+        settings += [('pickle', 'lz4'), ('msgpack', 'lz4')]
+    except ImportError:
+        pass
+
+    print('%-16s %-8s %-6s %10s %12s %12s' % ('payload', 'codec', 'comp', 'bytes', 'encode (us)', 'decode (us)'))
+    for name, payload in _payloads().items():
+        for codec, compress in settings:
+            data = kata.cache._encode(payload, codec, compress)
+            encode = _time(lambda: kata.cache._encode(payload, codec, compress), iterations)
+            decode = _time(lambda: kata.cache._decode(data), iterations)
+            print('%-16s %-8s %-6s %10s %12.1f %12.1f' % (name, codec, compress or '-', len(data), encode, decode))
+
+if __name__ == '__main__':
+    run()
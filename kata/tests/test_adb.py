@@ -0,0 +1,83 @@
+import unittest
+import kata.adb
+import kata.db
+
+config = {
+    'name': 'test_kata',
+    'user': 'test_kata',
+    'password': 'test_kata',
+    'host': 'localhost',
+    'port': 5432,
+}
+
+kata.adb.initialize(config)
+
+class Table(kata.db.Object):
+    __table__ = 'test_table'
+
+class TestADB(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await kata.adb.execute('drop table if exists test_table')
+        await kata.adb.execute('''
+            create table test_table (
+                id bigserial primary key,
+                test_integer integer not null,
+                test_varchar varchar(255) not null,
+                test_text text
+            )
+        ''')
+        await kata.adb.execute('''
+            insert into test_table
+                (test_integer, test_varchar, test_text)
+            values
+                (1, 'varchar', 'text'),
+                (2, 'foo', 'bar'),
+                (1, 'foo', 'baz')
+        ''')
+
+    async def asyncTearDown(self):
+        await kata.adb.close()
+
+    async def test_create(self):
+        row = await Table.acreate({'test_integer': 3, 'test_varchar': 'qux'})
+        self.assertEqual(row.id, 4)
+
+        rows = await Table.acreate([{'test_integer': 4, 'test_varchar': 'qux'} for _ in range(2)])
+        self.assertEqual([row.id for row in rows], [5, 6])
+        self.assertEqual(len(await Table.aget({'test_varchar': 'qux'})), 3)
+
+    async def test_delete(self):
+        await Table.adelete(where={'test_text': 'bar'})
+        self.assertEqual(len(await Table.aget()), 2)
+
+        await Table.adelete(where_in=('test_integer', [1]))
+        self.assertEqual(len(await Table.aget()), 0)
+
+    async def test_get(self):
+        self.assertEqual(len(await Table.aget()), 3)
+        self.assertEqual(len(await Table.aget({'test_integer': 1})), 2)
+
+        row = await Table.aget({'test_integer': 2}, one=True)
+        self.assertIsInstance(row, Table)
+        self.assertEqual(row.test_varchar, 'foo')
+        self.assertEqual(row.test_text, 'bar')
+
+        self.assertEqual(len(await Table.aget(where_in=('test_text', ['bar', 'baz']))), 2)
+        self.assertEqual(len(await Table.aget(where={'test_integer': 1}, where_in=('test_text', ['bar', 'baz']))), 1)
+
+        rows = await Table.aget(order_by='test_integer desc', limit=2, offset=1)
+        self.assertEqual([row.test_integer for row in rows], [1, 1])
+
+    async def test_query(self):
+        rows = await Table.aquery('select count(*) from __table__ where test_integer = %s', [1])
+        self.assertEqual(rows[0][0], 2)
+
+    async def test_update(self):
+        await Table.aupdate({'test_text': 'qux'})
+        self.assertEqual(len(await Table.aget({'test_text': 'qux'})), 3)
+
+        await Table.aupdate({'test_integer': 3}, {'test_varchar': 'foo'})
+        self.assertEqual(len(await Table.aget({'test_integer': 3})), 2)
+
+if __name__ == '__main__':
+    unittest.main()
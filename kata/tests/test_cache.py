@@ -1,5 +1,12 @@
+import asyncio
+import datetime
+import decimal
+import pickle
 import unittest
 import kata.cache
+import kata.db
+
+from unittest.mock import Mock, patch
 
 class _Base(object):
     data = {
@@ -22,6 +29,35 @@ class _Base(object):
             cache.delete(key)
             self.assertEqual(cache.get(key), None)
 
+    def test_add(self):
+        cache = self._cache()
+        cache.delete_multi(['add1', 'add2'])
+
+        self.assertEqual(cache.add('add1', 1), True)
+        self.assertEqual(cache.add('add1', 2), False)
+        self.assertEqual(cache.get('add1'), 1)
+
+        self.assertEqual(cache.add_multi({'add1': 3, 'add2': 4}), ['add2'])
+        self.assertEqual(cache.get_multi(['add1', 'add2']), {'add1': 1, 'add2': 4})
+        cache.delete_multi(['add1', 'add2'])
+
+    def test_async(self):
+        cache = self._cache()
+
+        async def run():
+            await cache.adelete_multi(self.data.keys())
+            self.assertEqual(await cache.aget('int'), None)
+            self.assertEqual(await cache.aadd('int', 123), True)
+            self.assertEqual(await cache.aadd('int', 456), False)
+
+            await cache.aset_multi(self.data)
+            self.assertEqual(await cache.aget_multi(self.data.keys()), self.data)
+
+            await cache.adelete_multi(self.data.keys())
+            self.assertEqual(await cache.aget_multi(self.data.keys()), {key: None for key in self.data.keys()})
+
+        asyncio.run(run())
+
     def test_multi(self):
         cache = self._cache()
         keys = self.data.keys()
@@ -37,6 +73,40 @@ class _Base(object):
         for key, value in deleted.items():
             self.assertEqual(value, None)
 
+class Model(kata.db.Object):
+    __table__ = 'model'
+
+class TestCodecs(unittest.TestCase):
+    def test_codecs(self):
+        value = {
+            1: Model(id=1, created_dt=datetime.datetime(2020, 1, 1), score=decimal.Decimal('1.5')),
+            'list': [1, 2, 3],
+            'set': {'foo'},
+            'tuple': (1, ('a', 2)),
+            (1, 2): 'tuple key',
+        }
+
+        for codec in ['pickle', 'msgpack']:
+            for compress in [None, 'zlib']:
+                result = kata.cache._decode(kata.cache._encode(value, codec, compress, compress_threshold=10))
+                self.assertIsInstance(result[1], Model)
+                self.assertEqual(result[1].fields(), value[1].fields())
+                self.assertEqual(result['list'], value['list'])
+                self.assertEqual(result['set'], value['set'])
+                self.assertEqual(result['tuple'], value['tuple'])
+                self.assertEqual(result[(1, 2)], 'tuple key')
+
+    def test_compress_threshold(self):
+        small = kata.cache._encode('foo', compress='zlib', compress_threshold=1024)
+        large = kata.cache._encode('foo' * 1000, compress='zlib', compress_threshold=1024)
+        self.assertEqual(small[0] & kata.cache._compressed_zlib, 0)
+        self.assertLess(len(large), 1000)
+        self.assertEqual(kata.cache._decode(large), 'foo' * 1000)
+
+    def test_legacy(self):
+        # values written before codecs were added should still be readable
+        self.assertEqual(kata.cache._decode(pickle.dumps({'foo': 'bar'})), {'foo': 'bar'})
+
 class TestMemcached(_Base, unittest.TestCase):
     def _cache(self):
         return kata.cache.Memcached(hosts=[('localhost:11211')], prefix='test')
@@ -45,9 +115,134 @@ class TestMemory(_Base, unittest.TestCase):
     def _cache(self):
         return kata.cache.Memory()
 
+    def test_expire(self):
+        cache = kata.cache.Memory()
+        with patch('time.time', return_value=1000):
+            cache.set_multi({i: i for i in range(5)}, expire=10)
+            cache.set('forever', 1)
+
+        # expired entries should be purged by later writes, even if they're never read again
+        with patch('time.time', return_value=1011):
+            self.assertEqual(cache.size(), 6)
+            cache.set('new', 1)
+            self.assertEqual(cache.size(), 2)
+            self.assertEqual(cache.get('forever'), 1)
+
+    def test_max_bytes(self):
+        cache = kata.cache.Memory(max_bytes=1000)
+        for i in range(10):
+            cache.set(i, 'x' * 200)
+
+        self.assertLessEqual(cache.stats()['bytes'], 1000)
+        self.assertEqual(cache.get(0), None)
+        self.assertEqual(cache.get(9), 'x' * 200)
+
+    def test_max_items(self):
+        cache = kata.cache.Memory(max_items=3)
+        cache.set_multi({'a': 1, 'b': 2, 'c': 3})
+
+        # reading a key should protect it from eviction
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('d', 4)
+        self.assertEqual(cache.get_multi(['a', 'b', 'c', 'd']), {'a': 1, 'b': None, 'c': 3, 'd': 4})
+        self.assertEqual(cache.size(), 3)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.hit_ratio(), 0.8)
+
 class TestRedis(_Base, unittest.TestCase):
     def _cache(self):
         return kata.cache.Redis(db=0, host='localhost:6379', prefix='test')
 
+    def test_chunks(self):
+        cache = kata.cache.Redis(db=0, host='localhost:6379', prefix='test', chunk_size=2)
+        data = {'chunk:%s' % i: i for i in range(5)}
+
+        # values and their expirations should be set across multiple chunks
+        cache.set_multi(data, expire=60)
+        self.assertEqual(cache.get_multi(data.keys()), data)
+        for key in data.keys():
+            self.assertGreater(cache.store.ttl('test' + key), 0)
+
+        cache.delete_multi(data.keys())
+        self.assertEqual(cache.get_multi(data.keys()), {key: None for key in data.keys()})
+
+class TestRedisSharded(_Base, unittest.TestCase):
+    def _cache(self):
+        return kata.cache.RedisSharded(db=0, hosts=['localhost:6379'], prefix='test')
+
+    def test_ring(self):
+        hosts = ['localhost:6379', 'localhost:6380', 'localhost:6381']
+        cache = kata.cache.RedisSharded(db=0, hosts=hosts, prefix='test')
+        larger = kata.cache.RedisSharded(db=0, hosts=hosts + ['localhost:6382'], prefix='test')
+        keys = ['key:%s' % i for i in range(3000)]
+
+        # keys should be spread across every node
+        counts = [0] * len(hosts)
+        for key in keys:
+            counts[cache.nodes.index(cache._node(key))] += 1
+        for count in counts:
+            self.assertGreater(count, 600)
+
+        # adding a node should only move about a quarter of the keys
+        moved = len([key for key in keys if cache.nodes.index(cache._node(key)) != larger.nodes.index(larger._node(key))])
+        self.assertLess(moved, 1200)
+
+class TestTiered(_Base, unittest.TestCase):
+    def _cache(self):
+        return kata.cache.Tiered(local=kata.cache.Memory(), remote=kata.cache.Memory())
+
+    def test_local(self):
+        cache = self._cache()
+        cache.remote.set('foo', 'bar')
+
+        # reads should fill the local cache, so later reads don't hit the remote cache
+        self.assertEqual(cache.get_multi(['foo', 'baz']), {'foo': 'bar', 'baz': None})
+        with patch.object(cache.remote, 'get', side_effect=AssertionError()):
+            self.assertEqual(cache.get('foo'), 'bar')
+
+        # an invalidation from another worker should only clear the local cache
+        cache._invalidate({'data': kata.cache._serialize(['foo'])})
+        self.assertEqual(cache.local.get('foo'), None)
+        self.assertEqual(cache.get('foo'), 'bar')
+
+    def test_local_expire(self):
+        cache = self._cache()
+        with patch('time.time', return_value=1000):
+            cache.set('foo', 'bar', expire=60)
+
+        # local entries should expire sooner than remote ones
+        with patch('time.time', return_value=1010):
+            self.assertEqual(cache.local.get('foo'), None)
+            self.assertEqual(cache.remote.get('foo'), 'bar')
+
+    def test_subscribe(self):
+        cache = kata.cache.Tiered(local=kata.cache.Memory(), remote=kata.cache.Memory(), channel='test')
+        cache.remote.store = Mock()
+        cache.local.set('foo', 'bar')
+
+        # each process should only subscribe once
+        cache.get('foo')
+        cache.get('foo')
+        self.assertEqual(cache.remote.store.pubsub.call_count, 1)
+
+        # losing the subscription should drop local values, since deletes may have been missed, and subscribe again
+        pubsub = cache.remote.store.pubsub.return_value
+        thread = Mock()
+        cache._unsubscribed(Exception(), pubsub, thread)
+        self.assertEqual(thread.stop.called, True)
+        self.assertEqual(cache.local.get('foo'), None)
+        cache.get('foo')
+        self.assertEqual(cache.remote.store.pubsub.call_count, 2)
+
+    def test_release(self):
+        cache = self._cache()
+        self.assertEqual(cache.add('lock:foo', 1, 10), True)
+
+        # locks should be released without broadcasting an invalidation
+        with patch.object(cache, '_publish') as mock_publish:
+            cache.release('lock:foo')
+            self.assertEqual(mock_publish.called, False)
+            self.assertEqual(cache.add('lock:foo', 1, 10), True)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,12 @@
+import asyncio
+import threading
+import time
+import types
 import unittest
 import kata.cache
 import kata.container
+import kata.memo
+import kata.warm
 
 from unittest.mock import patch
 
@@ -11,6 +17,8 @@ simple2_cache = kata.cache.Memory()
 simple3_cache = kata.cache.Memory()
 simple4_cache = kata.cache.Memory()
 simple5_cache = kata.cache.Memory()
+simple6_cache = kata.cache.Memory()
+simple7_cache = kata.cache.Memory()
 
 class SimpleContainer(kata.container.Simple):
     def init(self, foo):
@@ -35,6 +43,19 @@ class AttributeContainer(kata.container.Attribute):
     def pull(self, items):
         return _attribute_pull(items)
 
+class SimpleContainerOtherCache(kata.container.Simple):
+    def init(self, foo):
+        self.foo = foo
+
+    def cache(self):
+        return simple2_cache
+
+    def key(self):
+        return 'simple:%s' % self.foo
+
+    def pull(self):
+        return -self.foo
+
 class SimpleContainerWithDependency(kata.container.Simple):
     def init(self, foo):
         self.foo = foo
@@ -99,6 +120,23 @@ class SimpleContainerWithCycle2(kata.container.Simple):
     def pull(self):
         return _simple_pull(self.foo)
 
+class AttributeContainerChunked(kata.container.Attribute):
+    def cache(self):
+        return attribute_cache
+
+    def key(self, item):
+        return 'chunked:%s' % item
+
+    def pull(self, items):
+        return _attribute_pull(items)
+
+    def pull_chunk_size(self):
+        return 2
+
+class AttributeContainerChunkedProcesses(AttributeContainerChunked):
+    def pull_processes(self):
+        return True
+
 class AttributeContainerWithDependecy(kata.container.Attribute):
     def cache(self):
         return attribute2_cache
@@ -112,12 +150,175 @@ class AttributeContainerWithDependecy(kata.container.Attribute):
     def pull(self, items):
         return _attribute_pull(items)
 
+class SimpleContainerWithNamespace(kata.container.Simple):
+    def init(self, foo):
+        self.foo = foo
+
+    def cache(self):
+        return simple_cache
+
+    def key(self):
+        return 'simple8:%s' % self.foo
+
+    def namespace(self):
+        return 'simple8'
+
+    def pull(self):
+        return _simple_pull(self.foo)
+
+class SimpleContainerWithDirty(kata.container.Simple):
+    dirtied = []
+
+    def init(self, foo):
+        self.foo = foo
+
+    def cache(self):
+        return simple_cache
+
+    def dependencies(self):
+        return (SimpleContainer, self.foo)
+
+    def dirty(self, *, background=False):
+        SimpleContainerWithDirty.dirtied.append(self.foo)
+        super().dirty(background=background)
+
+    def key(self):
+        return 'simple9:%s' % self.foo
+
+    def pull(self):
+        return _simple_pull(self.foo)
+
+class SimpleContainerWithDirtyDependency(kata.container.Simple):
+    def init(self, foo):
+        self.foo = foo
+
+    def cache(self):
+        return simple_cache
+
+    def dependencies(self):
+        return (SimpleContainerWithDirty, self.foo)
+
+    def key(self):
+        return 'simple10:%s' % self.foo
+
+    def pull(self):
+        return _simple_pull(self.foo)
+
+class SimpleContainerWithLock(kata.container.Simple):
+    def init(self, foo):
+        self.foo = foo
+
+    def cache(self):
+        return simple6_cache
+
+    def early_recompute(self):
+        return 1
+
+    def key(self):
+        return 'simple6:%s' % self.foo
+
+    def lock_wait(self):
+        return 0.1
+
+    def pull(self):
+        return _simple_pull(self.foo)
+
+class SimpleContainerWithStale(kata.container.Simple):
+    def init(self, foo):
+        self.foo = foo
+
+    def cache(self):
+        return simple7_cache
+
+    def key(self):
+        return 'simple7:%s' % self.foo
+
+    def pull(self):
+        return _simple_pull(self.foo)
+
+    def stale(self):
+        return 60
+
+class AttributeContainerWithMissing(kata.container.Attribute):
+    def cache(self):
+        return attribute_cache
+
+    def key(self, item):
+        return 'attribute4:%s' % item
+
+    def missing_expire(self):
+        return 60
+
+    def pull(self, items):
+        return {item: item for item in items if item != 3}
+
+class AttributeContainerWithNamespace(kata.container.Attribute):
+    def cache(self):
+        return attribute_cache
+
+    def key(self, item):
+        return 'attribute5:%s' % item
+
+    def namespace(self, item):
+        return 'attribute5:%s' % (item % 2)
+
+    def pull(self, items):
+        return _attribute_pull(items)
+
+class AttributeContainerWithStale(kata.container.Attribute):
+    def cache(self):
+        return attribute_cache
+
+    def key(self, item):
+        return 'attribute3:%s' % item
+
+    def pull(self, items):
+        return _attribute_pull(items)
+
+    def stale(self):
+        return 60
+
+class AsyncModel(object):
+    @classmethod
+    async def aget(cls, where_in=None):
+        column, values = where_in
+        return [types.SimpleNamespace(**{column: value}) for value in values]
+
+class AttributeContainerWithAttribute(kata.container.Attribute):
+    def attribute(self):
+        return (AsyncModel, 'id')
+
+    def cache(self):
+        return attribute_cache
+
+    def key(self, item):
+        return 'attribute6:%s' % item
+
+class AsyncContainer(kata.container.Simple):
+    def init(self, foo):
+        self.foo = foo
+
+    def cache(self):
+        return simple_cache
+
+    def key(self):
+        return 'async:%s' % self.foo
+
+    async def pull(self):
+        await asyncio.sleep(0)
+        return _simple_pull(self.foo)
+
 def _attribute_pull(items):
     return {item: item for item in items}
 
 def _simple_pull(item):
     return item
 
+def _wait_for(condition):
+    deadline = time.time() + 1
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
 class TestContainer(unittest.TestCase):
     def test_attribute(self):
         first_items = [1, 2, 3]
@@ -183,6 +384,179 @@ class TestContainer(unittest.TestCase):
             self.assertEqual(AttributeContainer(third_items).get(), _attribute_pull(third_items))
             mock_pull.assert_called_once_with(first_items)
 
+    def test_attribute_chunks(self):
+        items = [1, 2, 3, 4, 5]
+        attribute_cache.delete_multi(['chunked:%s' % item for item in items])
+
+        with patch.object(AttributeContainerChunked, 'pull', side_effect=_attribute_pull) as mock_pull:
+            # misses should be pulled in chunks, and every chunk should be cached
+            self.assertEqual(AttributeContainerChunked(items).get(), _attribute_pull(items))
+            self.assertEqual(mock_pull.call_count, 3)
+            self.assertEqual(sorted(len(call[0][0]) for call in mock_pull.call_args_list), [1, 2, 2])
+            self.assertEqual(attribute_cache.get_multi(['chunked:%s' % item for item in items]), {
+                'chunked:%s' % item: item for item in items
+            })
+
+        # chunks can also be pulled in other processes
+        attribute_cache.delete_multi(['chunked:%s' % item for item in items])
+        self.assertEqual(AttributeContainerChunkedProcesses(items).get(), _attribute_pull(items))
+        self.assertEqual(attribute_cache.get('chunked:5'), 5)
+
+    def test_attribute_dependencies(self):
+        items = [1, 2]
+        self.assertEqual(AttributeContainerWithDependecy(items).get(), _attribute_pull(items))
+        self.assertEqual(AttributeContainer(items).get(), _attribute_pull(items))
+
+        with patch.object(AttributeContainer, 'pull', side_effect=_attribute_pull) as mock_pull, \
+                patch.object(AttributeContainerWithDependecy, 'pull', side_effect=_attribute_pull) as mock_pull2:
+            # dirtying should also dirty dependencies given as container instances
+            AttributeContainerWithDependecy(items).dirty()
+            self.assertEqual(AttributeContainerWithDependecy(items).get(), _attribute_pull(items))
+            self.assertEqual(AttributeContainer(items).get(), _attribute_pull(items))
+            mock_pull.assert_called_once_with(items)
+            mock_pull2.assert_called_once_with(items)
+
+    def test_attribute_lock(self):
+        items = [1, 2, 3]
+        for item in items:
+            attribute_cache.delete('attribute:%s' % item)
+
+        with patch.object(AttributeContainer, 'pull', side_effect=_attribute_pull) as mock_pull:
+            # items locked by another caller should be waited on, not pulled
+            attribute_cache.add('lock:attribute:2', 1, 10)
+            attribute_cache.set('attribute:2', 2)
+            self.assertEqual(AttributeContainer(items).get(), _attribute_pull(items))
+            mock_pull.assert_called_once_with([1, 3])
+
+            # locks should be released after pulling
+            self.assertEqual(attribute_cache.get('lock:attribute:1'), None)
+            self.assertEqual(attribute_cache.get('lock:attribute:3'), None)
+            attribute_cache.delete('lock:attribute:2')
+
+    def test_attribute_lock_released(self):
+        attribute_cache.delete('attribute:5')
+
+        def pull(items):
+            time.sleep(0.2)
+            return {}
+
+        with patch.object(AttributeContainer, 'pull', side_effect=pull) as mock_pull:
+            # once the caller holding the lock releases it without caching anything, waiters should stop waiting
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(AttributeContainer([5]).get())) for _ in range(3)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertLess(time.time() - start, 1)
+            self.assertEqual(results, [{}, {}, {}])
+            mock_pull.assert_called_once_with([5])
+            self.assertEqual(attribute_cache.get('lock:attribute:5'), None)
+
+    def test_attribute_missing(self):
+        items = [1, 2, 3]
+        for item in items:
+            attribute_cache.delete('attribute4:%s' % item)
+
+        # items that don't exist should be left out, and not pulled again
+        self.assertEqual(AttributeContainerWithMissing(items).get(), {1: 1, 2: 2})
+        with patch.object(AttributeContainerWithMissing, 'pull', return_value={}) as mock_pull:
+            self.assertEqual(AttributeContainerWithMissing(items).get(), {1: 1, 2: 2})
+            self.assertEqual(AttributeContainerWithMissing(3).get(), None)
+            self.assertEqual(mock_pull.called, False)
+
+        # dirtying should clear missing items too
+        AttributeContainerWithMissing(3).dirty()
+        with patch.object(AttributeContainerWithMissing, 'pull', return_value={3: 3}) as mock_pull:
+            self.assertEqual(AttributeContainerWithMissing(items).get(), {1: 1, 2: 2, 3: 3})
+            mock_pull.assert_called_once_with([3])
+
+    def test_attribute_namespace(self):
+        items = [1, 2, 3]
+        self.assertEqual(AttributeContainerWithNamespace(items).get(), _attribute_pull(items))
+
+        with patch.object(AttributeContainerWithNamespace, 'pull', side_effect=_attribute_pull) as mock_pull:
+            # dirtying an item should invalidate every item in its namespace
+            AttributeContainerWithNamespace(1).dirty()
+            self.assertEqual(AttributeContainerWithNamespace(items).get(), _attribute_pull(items))
+            mock_pull.assert_called_once_with([1, 3])
+
+    def test_attribute_stale(self):
+        items = [1, 2]
+        for item in items:
+            attribute_cache.delete('attribute3:%s' % item)
+        self.assertEqual(AttributeContainerWithStale(items).get(), _attribute_pull(items))
+
+        with patch.object(AttributeContainerWithStale, 'pull', return_value={1: 'new'}) as mock_pull:
+            # stale items should be returned immediately and refreshed in the background
+            attribute_cache.set('attribute3:1', kata.container._Entry(1, 0, time.time() + 60, time.time()))
+            self.assertEqual(AttributeContainerWithStale(items).get(), _attribute_pull(items))
+            _wait_for(lambda: attribute_cache.get('attribute3:1').value == 'new')
+            mock_pull.assert_called_once_with([1])
+
+    def test_loader(self):
+        items = [123, 456]
+        for item in items:
+            simple_cache.delete('simple:%s' % item)
+
+        with patch.object(SimpleContainer, 'pull', side_effect=[123, 456]) as mock_pull:
+            # loads shouldn't run until one of them is needed, and then should all run together
+            loader = kata.container.Loader()
+            first = loader.load(SimpleContainer(123))
+            second = loader.load(SimpleContainer(456))
+            self.assertEqual(mock_pull.called, False)
+            self.assertEqual(first.get(), 123)
+            self.assertEqual(mock_pull.call_count, 2)
+            self.assertEqual(second.get(), 456)
+            self.assertEqual(mock_pull.call_count, 2)
+
+    def test_memo(self):
+        items = [1, 2]
+        attribute_cache.delete_multi(['attribute:%s' % item for item in items])
+        simple_cache.delete('simple:123')
+
+        with kata.memo.scope(), \
+                patch.object(attribute_cache, 'get_multi', wraps=attribute_cache.get_multi) as mock_get_multi, \
+                patch.object(simple_cache, 'get', wraps=simple_cache.get) as mock_get:
+            # repeated gets during the same scope should only hit the cache once
+            self.assertEqual(AttributeContainer(items).get(), _attribute_pull(items))
+            self.assertEqual(AttributeContainer(items).get(), _attribute_pull(items))
+            self.assertEqual(AttributeContainer(1).get(), 1)
+            self.assertEqual(SimpleContainer(123).get(), 123)
+            self.assertEqual(SimpleContainer(123).get(), 123)
+            self.assertEqual(kata.container.Simple.get_multi([SimpleContainer(123)]), [123])
+            self.assertEqual(mock_get_multi.call_count, 1)
+            self.assertEqual(mock_get.call_count, 1)
+
+            # dirtying should forget everything remembered so far
+            SimpleContainer(123).dirty()
+            self.assertEqual(SimpleContainer(123).get(), 123)
+            self.assertEqual(mock_get.call_count, 2)
+
+        # outside of a scope, nothing should be remembered
+        with patch.object(simple_cache, 'get', wraps=simple_cache.get) as mock_get:
+            self.assertEqual(SimpleContainer(123).get(), 123)
+            self.assertEqual(SimpleContainer(123).get(), 123)
+            self.assertEqual(mock_get.call_count, 2)
+
+    def test_refresh_dedup(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def refresh(items):
+            started.set()
+            release.wait(1)
+
+        # a key that's already queued shouldn't be queued again until its refresh finishes
+        self.assertEqual(kata.container._refresh({'refresh:1': 1}, refresh), True)
+        started.wait(1)
+        self.assertEqual(kata.container._refresh({'refresh:1': 1}, refresh), False)
+        release.set()
+        _wait_for(lambda: 'refresh:1' not in kata.container._refresh_pending)
+        self.assertEqual(kata.container._refresh({'refresh:1': 1}, lambda items: None), True)
+
     def test_simple(self):
         item = 123
         simple_cache.delete('simple:%s' % item)
@@ -242,6 +616,46 @@ class TestContainer(unittest.TestCase):
             mock_pull.assert_called_once_with()
             mock_pull2.assert_called_once_with()
 
+    def test_simple_dependencies_batched(self):
+        item = 123
+
+        # the whole graph should be dirtied with one delete per cache
+        with patch.object(simple_cache, 'delete_multi', wraps=simple_cache.delete_multi) as mock_delete_multi, \
+                patch.object(simple3_cache, 'delete_multi', wraps=simple3_cache.delete_multi) as mock_delete_multi3:
+            SimpleContainerWithDependency2(item).dirty()
+            mock_delete_multi.assert_called_once_with(['simple2:%s' % item, 'simple:%s' % item])
+            mock_delete_multi3.assert_called_once_with(['simple3:%s' % item])
+
+    def test_simple_dependencies_override(self):
+        item = 123
+        SimpleContainerWithDirty.dirtied = []
+        SimpleContainer(item).get()
+        SimpleContainerWithDirty(item).get()
+
+        # dependencies that override dirty should have it called, along with their own dependencies
+        SimpleContainerWithDirtyDependency(item).dirty()
+        self.assertEqual(SimpleContainerWithDirty.dirtied, [item])
+        self.assertEqual(simple_cache.get('simple9:%s' % item), None)
+        self.assertEqual(simple_cache.get('simple:%s' % item), None)
+
+        # as should containers passed to dirty directly, without dirtying them twice
+        kata.container.dirty([SimpleContainerWithDirty(item)])
+        SimpleContainerWithDirty(item).dirty()
+        self.assertEqual(SimpleContainerWithDirty.dirtied, [item, item, item])
+
+        # background can only be passed by name
+        with self.assertRaises(TypeError):
+            SimpleContainer(item).dirty(True)
+
+    def test_simple_dirty_background(self):
+        item = 123
+        self.assertEqual(SimpleContainer(item).get(), _simple_pull(item))
+
+        # dirtying in the background should eventually remove the value
+        SimpleContainer(item).dirty(background=True)
+        _wait_for(lambda: simple_cache.get('simple:%s' % item) is None)
+        self.assertEqual(simple_cache.get('simple:%s' % item), None)
+
     def test_simple_dirty(self):
         item = 123
         simple_cache.delete('simple:%s' % item)
@@ -265,5 +679,267 @@ class TestContainer(unittest.TestCase):
             self.assertEqual(SimpleContainer(item).get(), _simple_pull(item))
             mock_pull.assert_called_once_with()
 
+    def test_simple_early_recompute(self):
+        item = 123
+        key = 'simple6:%s' % item
+        simple6_cache.delete(key)
+        self.assertEqual(SimpleContainerWithLock(item).get(), _simple_pull(item))
+
+        with patch.object(SimpleContainerWithLock, 'pull', return_value=_simple_pull(item)) as mock_pull:
+            # values far from expiring should not be recomputed
+            self.assertEqual(SimpleContainerWithLock(item).get(), _simple_pull(item))
+            self.assertEqual(mock_pull.called, False)
+
+            # values about to expire should be recomputed early
+            simple6_cache.set(key, kata.container._Entry(item, 1, time.time()))
+            self.assertEqual(SimpleContainerWithLock(item).get(), _simple_pull(item))
+            mock_pull.assert_called_once_with()
+
+        with patch.object(SimpleContainerWithLock, 'pull', return_value=_simple_pull(item)) as mock_pull:
+            # while another caller is recomputing, the stale value should be returned
+            simple6_cache.set(key, kata.container._Entry(item, 1, time.time()))
+            simple6_cache.add('lock:%s' % key, 1, 10)
+            self.assertEqual(SimpleContainerWithLock(item).get(), _simple_pull(item))
+            self.assertEqual(mock_pull.called, False)
+            simple6_cache.delete('lock:%s' % key)
+
+    def test_simple_get_multi(self):
+        simple_cache.delete('simple:1')
+        simple_cache.delete('simple:2')
+        simple3_cache.delete('simple3:1')
+        SimpleContainer(3).get()
+
+        containers = [SimpleContainer(1), SimpleContainer(2), SimpleContainer(3), SimpleContainer(1)]
+        containers.append(SimpleContainerWithDependency2(1))
+        with patch.object(simple_cache, 'get_multi', wraps=simple_cache.get_multi) as mock_get_multi, \
+                patch.object(simple_cache, 'set_multi', wraps=simple_cache.set_multi) as mock_set_multi:
+            # misses should be pulled once per key, with one get and set per cache
+            self.assertEqual(kata.container.Simple.get_multi(containers, parallel=True), [1, 2, 3, 1, 1])
+            self.assertEqual(mock_get_multi.call_count, 1)
+            self.assertEqual(mock_set_multi.call_count, 1)
+            self.assertEqual(simple_cache.get('simple:2'), 2)
+            self.assertEqual(simple3_cache.get('simple3:1'), 1)
+
+        with patch.object(SimpleContainer, 'pull') as mock_pull:
+            # second execution should not run pull again
+            self.assertEqual(kata.container.Simple.get_multi(containers), [1, 2, 3, 1, 1])
+            self.assertEqual(mock_pull.called, False)
+
+        # containers with the same key in different caches are different containers
+        simple2_cache.delete('simple:1')
+        self.assertEqual(kata.container.Simple.get_multi([SimpleContainer(1), SimpleContainerOtherCache(1)]), [1, -1])
+
+    def test_simple_lock(self):
+        item = 123
+        key = 'simple6:%s' % item
+        simple6_cache.delete(key)
+
+        with patch.object(SimpleContainerWithLock, 'pull', return_value=_simple_pull(item)) as mock_pull:
+            # while another caller holds the lock, we should wait for it before pulling anyway
+            simple6_cache.add('lock:%s' % key, 1, 10)
+            self.assertEqual(SimpleContainerWithLock(item).get(), _simple_pull(item))
+            mock_pull.assert_called_once_with()
+            simple6_cache.delete('lock:%s' % key)
+
+        with patch.object(SimpleContainerWithLock, 'pull', return_value=_simple_pull(item)) as mock_pull:
+            # the lock should be released after pulling
+            SimpleContainerWithLock(item).dirty()
+            self.assertEqual(SimpleContainerWithLock(item).get(), _simple_pull(item))
+            mock_pull.assert_called_once_with()
+            self.assertEqual(simple6_cache.get('lock:%s' % key), None)
+
+    def test_simple_lock_released(self):
+        simple_cache.delete('simple:5')
+
+        def pull():
+            time.sleep(0.2)
+            return None
+
+        with patch.object(SimpleContainer, 'pull', side_effect=pull) as mock_pull:
+            # once the caller holding the lock releases it without caching anything, waiters should stop waiting
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(SimpleContainer(5).get())) for _ in range(3)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertLess(time.time() - start, 1)
+            self.assertEqual(results, [None, None, None])
+            mock_pull.assert_called_once_with()
+            self.assertEqual(simple_cache.get('lock:simple:5'), None)
+
+    def test_simple_missing(self):
+        item = 123
+        simple_cache.delete('simple:%s' % item)
+
+        with patch.object(SimpleContainer, 'missing_expire', return_value=60), \
+                patch.object(SimpleContainer, 'pull', return_value=None) as mock_pull:
+            # a missing value should be cached, and not pulled again
+            self.assertEqual(SimpleContainer(item).get(), None)
+            self.assertEqual(SimpleContainer(item).get(), None)
+            mock_pull.assert_called_once_with()
+
+        with patch.object(SimpleContainer, 'pull', return_value=None) as mock_pull:
+            # without missing_expire, missing values are pulled every time
+            SimpleContainer(item).dirty()
+            self.assertEqual(SimpleContainer(item).get(), None)
+            self.assertEqual(SimpleContainer(item).get(), None)
+            self.assertEqual(mock_pull.call_count, 2)
+
+    def test_simple_namespace(self):
+        self.assertEqual(SimpleContainerWithNamespace(1).get(), 1)
+        self.assertEqual(SimpleContainerWithNamespace(2).get(), 2)
+
+        with patch.object(SimpleContainerWithNamespace, 'pull', return_value=3) as mock_pull:
+            # dirtying should invalidate everything in the namespace with one set
+            with patch.object(simple_cache, 'delete_multi') as mock_delete_multi, \
+                    patch.object(simple_cache, 'set_multi', wraps=simple_cache.set_multi) as mock_set_multi:
+                SimpleContainerWithNamespace(1).dirty()
+                self.assertEqual(mock_delete_multi.called, False)
+                self.assertEqual(mock_set_multi.call_count, 1)
+
+            self.assertEqual(SimpleContainerWithNamespace(1).get(), 3)
+            self.assertEqual(SimpleContainerWithNamespace(2).get(), 3)
+            self.assertEqual(mock_pull.call_count, 2)
+
+        with patch.object(kata.container, '_generation_ttl', 0), \
+                patch.dict(kata.container._generations_local, clear=True):
+            # other processes dirtying the namespace should be seen once the local generation expires
+            self.assertEqual(SimpleContainerWithNamespace(1).get(), 3)
+            simple_cache.set('generation:simple8', 'other')
+            self.assertEqual(SimpleContainerWithNamespace(1).get(), 1)
+
+        # tiered caches should delete the old generation first, so other workers drop it too
+        tiered = kata.cache.Tiered(local=kata.cache.Memory(), remote=kata.cache.Memory())
+        with patch.object(tiered, '_publish') as mock_publish:
+            kata.container._bump(tiered, ['simple8'])
+            mock_publish.assert_called_once_with(['generation:simple8'])
+
+    def test_simple_stale(self):
+        item = 123
+        key = 'simple7:%s' % item
+        simple7_cache.delete(key)
+        self.assertEqual(SimpleContainerWithStale(item).get(), _simple_pull(item))
+
+        with patch.object(SimpleContainerWithStale, 'pull', return_value=456) as mock_pull:
+            # fresh values should not be refreshed
+            self.assertEqual(SimpleContainerWithStale(item).get(), _simple_pull(item))
+            self.assertEqual(mock_pull.called, False)
+
+            # stale values should be returned immediately and refreshed in the background
+            simple7_cache.set(key, kata.container._Entry(item, 0, time.time() + 60, time.time()))
+            self.assertEqual(SimpleContainerWithStale(item).get(), _simple_pull(item))
+            _wait_for(lambda: simple7_cache.get(key).value == 456)
+            mock_pull.assert_called_once_with()
+
+    def test_warm(self):
+        items = list(range(10))
+        attribute_cache.delete_multi(['attribute:%s' % item for item in items])
+        AttributeContainer([0]).get()
+
+        with patch.object(AttributeContainer, 'pull', side_effect=_attribute_pull) as mock_pull:
+            # misses should be pulled a batch at a time, skipping anything that's already cached
+            self.assertEqual(kata.container.warm(AttributeContainer, items, batch_size=4, concurrency=2), 10)
+            self.assertEqual(sorted(len(call[0][0]) for call in mock_pull.call_args_list), [2, 3, 4])
+            self.assertEqual(AttributeContainer(items).get(), _attribute_pull(items))
+            self.assertEqual(mock_pull.call_count, 3)
+
+        simple_cache.delete_multi(['simple:%s' % item for item in items])
+        with patch.object(SimpleContainer, 'pull', return_value=1) as mock_pull:
+            # batches should be sent no faster than the rate
+            start = time.time()
+            self.assertEqual(kata.container.warm(SimpleContainer, items, batch_size=5, rate=50), 10)
+            self.assertGreaterEqual(time.time() - start, 0.1)
+            self.assertEqual(mock_pull.call_count, 10)
+            self.assertEqual(simple_cache.get('simple:9'), 1)
+
+    def test_warm_command(self):
+        attribute_cache.delete_multi(['attribute:%s' % item for item in [1, 2]])
+        with patch('builtins.print'):
+            kata.warm.main(['%s:AttributeContainer' % __name__, '1', '2', '--int'])
+
+        self.assertEqual(attribute_cache.get_multi(['attribute:1', 'attribute:2']), {'attribute:1': 1, 'attribute:2': 2})
+
+class TestContainerAsync(unittest.IsolatedAsyncioTestCase):
+    async def test_attribute(self):
+        items = [1, 2, 3]
+        attribute_cache.delete_multi(['attribute:%s' % item for item in items])
+
+        with patch.object(AttributeContainer, 'pull', side_effect=_attribute_pull) as mock_pull:
+            # async gets should share the cache with sync gets
+            self.assertEqual(await AttributeContainer(items).aget(), _attribute_pull(items))
+            self.assertEqual(AttributeContainer(items).get(), _attribute_pull(items))
+            self.assertEqual(await AttributeContainer(1).aget(), 1)
+            mock_pull.assert_called_once_with(items)
+
+    async def test_attribute_chunks(self):
+        items = [1, 2, 3, 4, 5]
+        attribute_cache.delete_multi(['chunked:%s' % item for item in items])
+
+        with patch.object(AttributeContainerChunked, 'pull', side_effect=_attribute_pull) as mock_pull:
+            self.assertEqual(await AttributeContainerChunked(items).aget(), _attribute_pull(items))
+            self.assertEqual(mock_pull.call_count, 3)
+            self.assertEqual(attribute_cache.get('chunked:5'), 5)
+
+    async def test_attribute_default_pull(self):
+        attribute_cache.delete_multi(['attribute6:1', 'attribute6:2'])
+
+        # the default pull should use the model's aget
+        with patch.object(AsyncModel, 'aget', wraps=AsyncModel.aget) as mock_aget:
+            result = await AttributeContainerWithAttribute([1, 2]).aget()
+            self.assertEqual({k: v.id for k, v in result.items()}, {1: 1, 2: 2})
+            mock_aget.assert_called_once_with(where_in=('id', [1, 2]))
+
+    async def test_simple(self):
+        items = [1, 2, 3]
+        simple_cache.delete_multi(['async:%s' % item for item in items])
+
+        # coroutine pulls should be awaited, and gets should be able to run concurrently
+        results = await asyncio.gather(*[AsyncContainer(item).aget() for item in items])
+        self.assertEqual(results, items)
+        self.assertEqual(simple_cache.get('async:1'), 1)
+
+        with patch.object(AsyncContainer, 'pull') as mock_pull:
+            self.assertEqual(await AsyncContainer(1).aget(), 1)
+            self.assertEqual(mock_pull.called, False)
+
+        # dirtying should remove the value
+        await AsyncContainer(1).adirty()
+        self.assertEqual(simple_cache.get('async:1'), None)
+
+    async def test_simple_sync_pull(self):
+        simple_cache.delete('simple:123')
+
+        with patch.object(SimpleContainer, 'pull', return_value=_simple_pull(123)) as mock_pull:
+            # containers with a regular pull should work with async gets too
+            self.assertEqual(await SimpleContainer(123).aget(), 123)
+            self.assertEqual(await SimpleContainer(123).aget(), 123)
+            mock_pull.assert_called_once_with()
+
+        def attribute_pull(items):
+            time.sleep(0.2)
+            return _attribute_pull(items)
+
+        def simple_pull():
+            time.sleep(0.2)
+            return 1
+
+        # regular pulls should run off of the event loop, so gets can run concurrently
+        attribute_cache.delete_multi(['attribute:1', 'attribute:2'])
+        simple_cache.delete_multi(['simple:1', 'simple:2'])
+        with patch.object(AttributeContainer, 'pull', side_effect=attribute_pull), \
+                patch.object(SimpleContainer, 'pull', side_effect=simple_pull):
+            start = time.time()
+            results = await asyncio.gather(
+                AttributeContainer(1).aget(),
+                AttributeContainer(2).aget(),
+                SimpleContainer(1).aget(),
+                SimpleContainer(2).aget()
+            )
+            self.assertEqual(results, [1, 2, 1, 1])
+            self.assertLess(time.time() - start, 0.6)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,17 +1,27 @@
+import pickle
 import unittest
 import kata.db
+import kata.memo
 
-kata.db.initialize({
+from unittest.mock import patch
+
+config = {
     'name': 'test_kata',
     'user': 'test_kata',
     'password': 'test_kata',
     'host': 'localhost',
     'port': 5432,
-})
+}
+
+kata.db.initialize(config)
 
 class Table(kata.db.Object):
     __table__ = 'test_table'
 
+class CompactTable(kata.db.Object):
+    __compact__ = True
+    __table__ = 'test_table'
+
 class TestDB(unittest.TestCase):
     def setUp(self):
         kata.db.execute('drop table if exists test_table')
@@ -24,6 +34,94 @@ class TestDB(unittest.TestCase):
             )
         ''')
 
+    def test_bulk_create(self):
+        rows = [
+            {'test_integer': i, 'test_varchar': 'varchar\t%s' % i, 'test_text': None if i % 2 else 'text\n'}
+            for i in range(25)
+        ]
+
+        # rows should be copied across multiple chunks
+        self.assertEqual(Table.bulk_create(rows, chunk_size=10), None)
+        result = Table.get(order_by='test_integer asc')
+        self.assertEqual(len(result), 25)
+        for row, data in zip(result, rows):
+            for k, v in data.items():
+                self.assertEqual(getattr(row, k), v)
+
+        # test returning ids
+        ids = Table.bulk_create(iter(rows[:5]), returning_ids=True)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(len(Table.get(where_in=('id', ids))), 5)
+
+    def test_bulk_create_arrays(self):
+        kata.db.execute('alter table test_table add column test_array text[]')
+        values = [['a', 'b "c"', 'd\\e\tf', None], []]
+
+        # lists should be copied as arrays, just like create binds them
+        Table.bulk_create([{'test_integer': i, 'test_varchar': 'foo', 'test_array': v} for i, v in enumerate(values)])
+        Table.create({'test_integer': 2, 'test_varchar': 'foo', 'test_array': values[0]})
+        result = Table.get(order_by='test_integer asc')
+        self.assertEqual([row.test_array for row in result], values + values[:1])
+
+    def test_bulk_create_unique(self):
+        kata.db.execute('create unique index test_table_test_integer on test_table (test_integer)')
+        Table.bulk_create([{'test_integer': i, 'test_varchar': 'foo'} for i in range(5)])
+
+        # conflicting rows should be updated rather than inserted
+        Table.bulk_create([{'test_integer': i, 'test_varchar': 'bar'} for i in range(3, 8)], unique='test_integer')
+        self.assertEqual(len(Table.get()), 8)
+        self.assertEqual(len(Table.get({'test_varchar': 'foo'})), 3)
+        self.assertEqual(len(Table.get({'test_varchar': 'bar'})), 5)
+
+    def test_columns(self):
+        kata.db.execute('''
+            insert into test_table
+                (test_integer, test_varchar, test_text)
+            select i, 'varchar', case when i % 2 = 0 then 'text' end from generate_series(1, 25) as i
+        ''')
+
+        columns = Table.get(order_by='test_integer asc', as_columns=True)
+        self.assertEqual(sorted(columns.keys()), ['id', 'test_integer', 'test_text', 'test_varchar'])
+        self.assertEqual(columns['test_integer'].dtype.kind, 'i')
+        self.assertEqual(columns['test_integer'].sum(), 325)
+        self.assertEqual(list(columns['test_text'][:2]), [None, 'text'])
+
+        # batches should be concatenated, and nulls in integer columns should become nan
+        columns = kata.db.query_columns('''
+            select case when test_integer > 20 then null else test_integer end as value, now() as created_dt
+            from test_table order by test_integer
+        ''', batch_size=10)
+        self.assertEqual(len(columns['value']), 25)
+        self.assertEqual(columns['value'].dtype.kind, 'f')
+        self.assertEqual(int(columns['value'][:20].sum()), 210)
+        self.assertEqual(columns['created_dt'].dtype.kind, 'M')
+
+    def test_compact(self):
+        kata.db.execute('''
+            insert into test_table
+                (test_integer, test_varchar, test_text)
+            values
+                (1, 'varchar', 'text'),
+                (2, 'foo', 'bar')
+        ''')
+
+        rows = CompactTable.get(order_by='test_integer asc')
+        self.assertEqual(len(rows), 2)
+        self.assertIsInstance(rows[0], CompactTable)
+        self.assertEqual(rows[0].test_integer, 1)
+        self.assertEqual(rows[1].test_text, 'bar')
+        self.assertEqual(rows[0].fields(), {'id': 1, 'test_integer': 1, 'test_varchar': 'varchar', 'test_text': 'text'})
+
+        # the selected columns determine the row's fields
+        row = CompactTable.get({'test_integer': 2}, fields=['id', 'test_varchar'], one=True)
+        self.assertEqual(row.fields(), {'id': 2, 'test_varchar': 'foo'})
+
+        # compact rows should serialize and pickle like regular objects
+        self.assertEqual(kata.db.serialize(rows), kata.db.serialize(Table.get(order_by='test_integer asc')))
+        self.assertEqual(pickle.loads(pickle.dumps(rows[1])).fields(), rows[1].fields())
+        iterated = CompactTable.iter(order_by='test_integer asc')
+        self.assertEqual([row.fields() for row in iterated], [row.fields() for row in rows])
+
     def test_create(self):
         data = {
             'test_integer': 1,
@@ -54,6 +152,12 @@ class TestDB(unittest.TestCase):
                 (1, 'foo', 'baz')
         ''')
 
+        # deleting without conditions should fail rather than emptying the table
+        for kwargs in [{}, {'where': {}}, {'where_in': []}]:
+            with self.assertRaises(ValueError):
+                Table.delete(**kwargs)
+        self.assertEqual(len(Table.get()), 3)
+
         # test basic delete
         Table.delete(where={'test_text': 'bar'})
         self.assertEqual(len(Table.get()), 2)
@@ -99,6 +203,236 @@ class TestDB(unittest.TestCase):
         self.assertEqual(rows[0].test_integer, 1)
         self.assertEqual(rows[2].test_integer, 2)
 
+    def test_get_in_chunks(self):
+        kata.db.execute('''
+            insert into test_table
+                (test_integer, test_varchar, test_text)
+            select i, 'varchar', 'text' from generate_series(1, 10) as i
+        ''')
+
+        kata.db._where_in_chunk_size = 3
+        try:
+            # lists longer than the chunk size should be split into several queries
+            self.assertEqual(len(Table.get(where_in=('test_integer', list(range(1, 9))))), 8)
+            self.assertEqual(len(Table.get({'test_varchar': 'varchar'}, where_in=('test_integer', set(range(5))))), 4)
+
+            # strings containing quotes should be bound rather than rendered into the query
+            self.assertEqual(len(Table.get(where_in=('test_text', ["'text'", 'text", "text']))), 0)
+
+            # a chunked delete that fails partway through shouldn't delete anything
+            execute = kata.db.execute
+            calls = []
+            def fail(*args, **kwargs):
+                calls.append(args)
+                if len(calls) == 2:
+                    raise RuntimeError()
+                return execute(*args, **kwargs)
+
+            with patch.object(kata.db, 'execute', side_effect=fail), self.assertRaises(RuntimeError):
+                Table.delete(where_in=('test_integer', list(range(1, 8))))
+            self.assertEqual(len(Table.get()), 10)
+
+            Table.delete(where_in=('test_integer', list(range(1, 8))))
+            self.assertEqual(len(Table.get()), 3)
+        finally:
+            kata.db._where_in_chunk_size = 10000
+
+    def test_iter(self):
+        # populate table
+        kata.db.execute('''
+            insert into test_table
+                (test_integer, test_varchar, test_text)
+            select i, 'varchar', 'text' from generate_series(1, 25) as i
+        ''')
+
+        # batches smaller than the result set should still yield every row in order
+        rows = list(Table.iter(order_by='test_integer asc', batch_size=10))
+        self.assertEqual(len(rows), 25)
+        self.assertEqual([row.test_integer for row in rows], list(range(1, 26)))
+
+        # test iter with a where clause
+        self.assertEqual(len(list(Table.iter({'test_integer': 3}))), 1)
+
+        # abandoning an iterator partway through should still return the connection
+        iterator = Table.iter(batch_size=5)
+        next(iterator)
+        iterator.close()
+        self.assertEqual(len(Table.get()), 25)
+
+        # test module-level stream
+        self.assertEqual(len(list(kata.db.stream('select * from test_table where test_integer > %s', [20]))), 5)
+
+    def test_page(self):
+        kata.db.execute('''
+            insert into test_table
+                (test_integer, test_varchar, test_text)
+            select i % 3, 'varchar', 'text' from generate_series(1, 10) as i
+        ''')
+
+        # walk every page, ordering by a non-unique column with the id as a tiebreaker
+        seen = []
+        token = None
+        while True:
+            rows, token = Table.page(order_by=('test_integer', 'id'), after=token, limit=3)
+            seen += [(row.test_integer, row.id) for row in rows]
+            if token is None:
+                break
+
+        self.assertEqual(len(seen), 10)
+        self.assertEqual(seen, sorted(seen))
+
+        # test descending pages with a where clause and fields
+        rows, token = Table.page({'test_integer': 1}, fields=['test_varchar'], limit=2, descending=True)
+        self.assertEqual([row.id for row in rows], [10, 7])
+        rows, token = Table.page({'test_integer': 1}, fields=['test_varchar'], after=token, limit=2, descending=True)
+        self.assertEqual([row.id for row in rows], [4, 1])
+        self.assertEqual(token, None)
+
+    def test_prepared(self):
+        kata.db.execute('''
+            insert into test_table
+                (test_integer, test_varchar, test_text)
+            values
+                (1, 'varchar', 'text'),
+                (2, 'foo', 'bar'),
+                (1, 'foo', 'baz')
+        ''')
+
+        kata.db._prepared_limit = 2
+        try:
+            # repeated shapes should give the same results as unprepared statements
+            for _ in range(3):
+                self.assertEqual(len(Table.get({'test_integer': 1})), 2)
+                self.assertEqual(len(Table.get({'test_integer': 2})), 1)
+                self.assertEqual(len(Table.get({'test_varchar': 'foo'}, limit=1)), 1)
+                self.assertEqual(len(Table.get(order_by='test_integer asc', limit=2, offset=2)), 1)
+
+            # prepared statements past the limit should be deallocated
+            for statements in kata.db._prepared.values():
+                self.assertLessEqual(len(statements), 2)
+
+            Table.update({'test_text': 'qux'}, {'test_integer': 2})
+            Table.delete({'test_integer': 1})
+            self.assertEqual(len(Table.get({'test_text': 'qux'})), 1)
+        finally:
+            kata.db._prepared_limit = 0
+
+    def test_replicas(self):
+        kata.db.execute('''
+            insert into test_table
+                (test_integer, test_varchar, test_text)
+            values
+                (1, 'varchar', 'text'),
+                (2, 'foo', 'bar')
+        ''')
+
+        # use the same database as a replica, plus one that will fail to connect
+        replica = kata.db._create_pool(config, 0)
+        unreachable = kata.db._create_pool(dict(config, port=1), 0)
+        kata.db._replicas = [unreachable, replica]
+        try:
+            with patch.object(replica, 'getconn', wraps=replica.getconn) as mock_getconn:
+                for _ in range(3):
+                    self.assertEqual(len(Table.get()), 2)
+
+                # the replica that can't connect should be ejected, and reads should go to the healthy one
+                self.assertIn(unreachable, kata.db._replica_ejected)
+                self.assertEqual(mock_getconn.call_count, 3)
+
+                # locking reads, and reads that opt out, should go to the primary
+                Table.query('select * from __table__ for update')
+                Table.query('select * from __table__', replica=False)
+                self.assertEqual(mock_getconn.call_count, 3)
+
+            # the least busy replica should be preferred
+            with patch.object(kata.db, '_replica_strategy', 'least_busy'), \
+                    patch.dict(kata.db._replica_busy, {unreachable: 1}):
+                self.assertEqual(kata.db._replica_order(), [replica, unreachable])
+
+            # writes and forced primary reads should not use replicas
+            with kata.db.primary():
+                Table.update({'test_text': 'qux'}, {'test_integer': 2})
+                self.assertEqual(len(Table.get({'test_text': 'qux'})), 1)
+        finally:
+            kata.db._replicas = []
+            kata.db._replica_ejected.clear()
+            replica.closeall()
+            unreachable.closeall()
+
+    def test_memo(self):
+        data = {'test_integer': 1, 'test_varchar': 'varchar'}
+        Table.create(dict(data))
+
+        with kata.memo.scope():
+            # identical gets should only query once
+            first = Table.get({'test_integer': 1})
+            Table.execute('update __table__ set test_varchar = %s', ['changed'], placeholder='__table__')
+            self.assertEqual(Table.get({'test_integer': 1})[0].test_varchar, 'changed')
+
+            with patch.object(kata.db, 'query', wraps=kata.db.query) as mock_query:
+                second = Table.get({'test_integer': 1})
+                third = Table.get({'test_integer': 1})
+                self.assertEqual(mock_query.call_count, 0)
+                self.assertEqual(len(second), 1)
+                self.assertEqual(len(third), 1)
+
+            # writes should forget everything remembered so far
+            Table.create(dict(data))
+            self.assertEqual(len(Table.get({'test_integer': 1})), 2)
+            self.assertEqual(len(first), 1)
+
+    def test_transaction(self):
+        data = {'test_integer': 1, 'test_varchar': 'varchar'}
+
+        # writes in a transaction should be visible inside of it, and committed at the end
+        with kata.db.transaction():
+            Table.create(dict(data))
+            Table.create(dict(data))
+            self.assertEqual(len(Table.get()), 2)
+        self.assertEqual(len(Table.get()), 2)
+
+        # an exception should roll back the entire transaction
+        with self.assertRaises(ValueError):
+            with kata.db.transaction():
+                Table.create(dict(data))
+                raise ValueError()
+        self.assertEqual(len(Table.get()), 2)
+
+        # nested transactions should only roll back to their savepoint
+        with kata.db.transaction():
+            Table.create(dict(data))
+            with self.assertRaises(ValueError):
+                with kata.db.transaction():
+                    Table.create(dict(data))
+                    raise ValueError()
+
+            with kata.db.transaction():
+                Table.delete({'test_integer': 1})
+                Table.create(dict(data, test_integer=2))
+        self.assertEqual(len(Table.get()), 1)
+        self.assertEqual(len(Table.get({'test_integer': 2})), 1)
+
+    def test_transaction_on_commit(self):
+        called = []
+
+        # callbacks should run immediately outside of a transaction, and after commit inside of one
+        kata.db.on_commit(lambda: called.append(1))
+        with kata.db.transaction():
+            kata.db.on_commit(lambda: called.append(2))
+            with self.assertRaises(ValueError):
+                with kata.db.transaction():
+                    kata.db.on_commit(lambda: called.append(3))
+                    raise ValueError()
+            self.assertEqual(called, [1])
+        self.assertEqual(called, [1, 2])
+
+        # callbacks should be dropped when a transaction rolls back
+        with self.assertRaises(ValueError):
+            with kata.db.transaction():
+                kata.db.on_commit(lambda: called.append(4))
+                raise ValueError()
+        self.assertEqual(called, [1, 2])
+
     def test_update(self):
         # populate table
         kata.db.execute('''
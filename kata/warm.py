@@ -0,0 +1,63 @@
+import argparse
+import contextlib
+import importlib
+import itertools
+import sys
+import kata.container
+
+def _container(path):
+    # containers are given as module.Class or module:Class
+    module, _, name = path.rpartition(':') if ':' in path else path.rpartition('.')
+    return getattr(importlib.import_module(module), name)
+
+def _lines(path, convert):
+    # one item per line, skipping blank lines
+    with open(path, 'r') if path != '-' else contextlib.nullcontext(sys.stdin) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield convert(line)
+
+def _query(sql, batch_size):
+    import kata.db
+
+    # use the first column as the item, or every column as constructor arguments
+    for row in kata.db.stream(sql, batch_size=batch_size):
+        yield row[0] if len(row) == 1 else tuple(row)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pre-populate the cache for a container.')
+    parser.add_argument('container', help='container class, like app.containers.User')
+    parser.add_argument('items', nargs='*', help='items to warm')
+    parser.add_argument('--batch-size', type=int, default=1000, help='items to pull at a time')
+    parser.add_argument('--concurrency', type=int, default=1, help='batches to pull at the same time')
+    parser.add_argument('--config', help='config file to initialize kata with')
+    parser.add_argument('--file', help='file with one item per line, or - for stdin')
+    parser.add_argument('--int', action='store_true', help='treat items from arguments and files as integers')
+    parser.add_argument('--rate', type=float, default=0, help='maximum items to pull per second')
+    parser.add_argument('--sql', help='query that selects the items to warm')
+    args = parser.parse_args(argv)
+
+    if args.config:
+        import kata.config as config
+        config.initialize(args.config)
+
+    convert = int if args.int else str
+    items = [convert(item) for item in args.items]
+    if args.file:
+        items = itertools.chain(items, _lines(args.file, convert))
+    if args.sql:
+        items = itertools.chain(items, _query(args.sql, args.batch_size))
+
+    warmed = kata.container.warm(
+        _container(args.container),
+        items,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        rate=args.rate
+    )
+
+    print('Warmed %s items' % warmed)
+
+if __name__ == '__main__':
+    main()
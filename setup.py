@@ -6,9 +6,10 @@ setuptools.setup(
     author='Tommy MacWilliam',
     packages=setuptools.find_packages(),
     install_requires=[
+        'asyncpg',
         'falcon',
         'gunicorn',
-        'msgpack-python',
+        'msgpack>=1.0',
         'natsort',
         'psycopg2',
         'pylibmc',
@@ -16,5 +17,8 @@ setuptools.setup(
         'raven',
         'redis',
         'statsd',
-    ]
+    ],
+    extras_require={
+        'columns': ['numpy'],
+    }
 )